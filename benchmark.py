@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import base64
+import importlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import yaml
+from aiohttp import web
+from PIL import Image
+
+NETWORKS = ["Telegram", "VK", "Twitter", "Tumblr", "Bluesky"]
+PROFILE = "benchmark"
+TOKEN = "123456:BENCHMARK"
+BLUESKY_DID = "did:plc:benchmark"
+BLUESKY_CID = "bafkreigh2akiscaildcqabsyg3dfr6chu3fgpregiymsck7e7aqa4s52zy"
+
+# Every stand-in answers in the format of the real service, so the SDKs parse and classify errors as in production
+RATE_LIMITED = {
+    "telegram": lambda: web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                           "parameters": {"retry_after": 1}}, status=429),
+    "api.vk.com": lambda: web.json_response({"error": {"error_code": 6, "error_msg": "Too many requests per second",
+                                                       "request_params": []}}),
+    "vk-upload": lambda: web.Response(status=429, text="Too Many Requests", headers={"retry-after": "1"}),
+    "twitter": lambda: web.json_response({"errors": [{"code": 88, "message": "Rate limit exceeded"}]}, status=429,
+                                         headers={"x-rate-limit-reset": str(int(time.time()) + 1)}),
+    "api.tumblr.com": lambda: web.json_response({"meta": {"status": 429, "msg": "Limit Exceeded"}, "response": []},
+                                                status=429),
+    "bsky": lambda: web.json_response({"error": "RateLimitExceeded", "message": "Rate Limit Exceeded"}, status=429,
+                                      headers={"ratelimit-reset": str(int(time.time()) + 1)}),
+}
+SERVER_ERRORS = {
+    "telegram": lambda: web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"},
+                                          status=500),
+    "api.vk.com": lambda: web.Response(status=500, text="Internal Server Error"),
+    "twitter": lambda: web.json_response({"errors": [{"code": 131, "message": "Internal error"}]}, status=503),
+    "api.tumblr.com": lambda: web.json_response({"meta": {"status": 503, "msg": "Service Unavailable"}, "response": []},
+                                                status=503),
+    "bsky": lambda: web.json_response({"error": "InternalServerError", "message": "Internal Server Error"}, status=500),
+}
+
+def make_jwt(payload: dict) -> str:
+    def encode(data: bytes) -> str:
+        return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+    header = json.dumps({"alg": "ES256K", "typ": "JWT"}).encode()
+    return f"{encode(header)}.{encode(json.dumps(payload).encode())}.{encode(b'signature')}"
+
+def percentile(values: list[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+def generate_photo(side: int) -> bytes:
+    # Gradients with noise compress like a photo, and the noise makes every file unique
+    size = (side, side)
+    image = Image.merge("RGB", [
+        Image.linear_gradient("L").resize(size),
+        Image.radial_gradient("L").resize(size),
+        Image.effect_noise(size, 32),
+    ])
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+class MockNetworks:
+    def __init__(self, latency: float, jitter: float, error_rate: float, rate_limit: float, token_bucket: type):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        # The bot's own TokenBucket, the stand-ins limit requests the same way the bot paces them
+        self.token_bucket = token_bucket
+        self.buckets = {}
+        self.faults_enabled = False
+        self.files: dict[str, bytes] = {}
+        self.counter = 0
+        self.base_url = None
+        self.loop = None
+        self.runner = None
+        self.ready = threading.Event()
+
+    def next_id(self) -> int:
+        self.counter += 1
+        return self.counter
+
+    async def handle(self, request: web.Request) -> web.Response:
+        host, _, path = request.match_info["tail"].partition("/")
+        service = "twitter" if host.endswith("twitter.com") else host
+
+        await asyncio.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        if self.rate_limit and self.faults_enabled and service in RATE_LIMITED:
+            bucket = self.buckets.get(service)
+            if bucket is None:
+                bucket = self.buckets[service] = self.token_bucket(self.rate_limit, self.rate_limit)
+            if bucket.get_delay(1) > 0:
+                return RATE_LIMITED[service]()
+            bucket.take(1)
+        if self.faults_enabled and service in SERVER_ERRORS and random.random() < self.error_rate:
+            return SERVER_ERRORS[service]()
+
+        if service == "telegram":
+            return await self.handle_telegram(request, path)
+        if service == "api.vk.com" or service == "vk-upload":
+            return await self.handle_vk(request, path)
+        if service == "twitter":
+            return await self.handle_twitter(request, path)
+        if service == "api.tumblr.com":
+            return await self.handle_tumblr(request, path)
+        if service == "bsky":
+            return await self.handle_bluesky(request, path)
+        return web.Response(status=404)
+
+    async def handle_telegram(self, request: web.Request, path: str) -> web.Response:
+        if path.startswith("file/"):
+            file_id = os.path.splitext(os.path.basename(path))[0]
+            return web.Response(body=self.files[file_id])
+
+        method = path.rsplit("/", 1)[-1]
+        form = await request.post()
+        chat = {"id": int(form.get("chat_id", 1)), "type": "channel"}
+        if method == "getFile":
+            file_id = form["file_id"]
+            return web.json_response({"ok": True, "result": {
+                "file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg",
+            }})
+        if method == "sendMediaGroup":
+            media = json.loads(form["media"])
+            return web.json_response({"ok": True, "result": [
+                {"message_id": self.next_id(), "date": int(time.time()), "chat": chat} for _ in media
+            ]})
+        return web.json_response({"ok": True, "result": {
+            "message_id": self.next_id(), "date": int(time.time()), "chat": chat, "text": form.get("text", ""),
+        }})
+
+    async def handle_vk(self, request: web.Request, path: str) -> web.Response:
+        await request.read()
+        if path == "":
+            return web.json_response({"server": 1, "photo": json.dumps([{"photo": uuid.uuid4().hex}]),
+                                      "hash": uuid.uuid4().hex})
+
+        method = path.rsplit("/", 1)[-1]
+        if method == "photos.getWallUploadServer":
+            return web.json_response({"response": {"upload_url": f"{self.base_url}/vk-upload/", "album_id": 1,
+                                                   "user_id": 1}})
+        if method == "execute":
+            form = await request.post()
+            photos = [f"photo-1_{self.next_id()}" for _ in range(form["code"].count("API.photos.saveWallPhoto"))]
+            return web.json_response({"response": {"photos": photos, "post_id": self.next_id()}})
+        return web.json_response({"response": {}})
+
+    async def handle_twitter(self, request: web.Request, path: str) -> web.Response:
+        await request.read()
+        if path == "1.1/media/upload.json":
+            media_id = self.next_id()
+            return web.json_response({"media_id": media_id, "media_id_string": str(media_id),
+                                      "expires_after_secs": 86400})
+        if path == "2/users/me":
+            return web.json_response({"data": {"id": "1", "name": "Benchmark", "username": "benchmark"}})
+        if path == "2/tweets":
+            return web.json_response({"data": {"id": str(self.next_id()), "text": ""}}, status=201)
+        return web.Response(status=404)
+
+    async def handle_tumblr(self, request: web.Request, path: str) -> web.Response:
+        await request.read()
+        if path == "v2/user/info":
+            return web.json_response({"meta": {"status": 200, "msg": "OK"}, "response": {"user": {"name": "benchmark"}}})
+        post_id = self.next_id()
+        return web.json_response({"meta": {"status": 201, "msg": "Created"},
+                                  "response": {"id": post_id, "id_string": str(post_id)}}, status=201)
+
+    async def handle_bluesky(self, request: web.Request, path: str) -> web.Response:
+        body = await request.read()
+        method = path.rsplit("/", 1)[-1]
+        if method == "com.atproto.server.createSession":
+            now = int(time.time())
+            jwt = make_jwt({"sub": BLUESKY_DID, "iat": now, "exp": now + 86400, "scope": "com.atproto.access"})
+            return web.json_response({"accessJwt": jwt, "refreshJwt": jwt, "handle": "benchmark.bsky.social",
+                                      "did": BLUESKY_DID})
+        if method == "app.bsky.actor.getProfile":
+            return web.json_response({"did": BLUESKY_DID, "handle": "benchmark.bsky.social"})
+        if method == "com.atproto.repo.uploadBlob":
+            return web.json_response({"blob": {"$type": "blob", "ref": {"$link": BLUESKY_CID},
+                                               "mimeType": request.content_type, "size": len(body)}})
+        if method == "com.atproto.repo.createRecord":
+            return web.json_response({"uri": f"at://{BLUESKY_DID}/app.bsky.feed.post/{self.next_id()}",
+                                      "cid": BLUESKY_CID})
+        return web.json_response({"error": "MethodNotImplemented", "message": method}, status=501)
+
+    def run(self):
+        # The stand-ins get their own loop, so serving them doesn't compete with the publishers being measured
+        self.loop = asyncio.new_event_loop()
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.ready.set()
+        self.loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+def write_config(directory: str):
+    credentials = {
+        "TG_CHANNEL_ID": -1000000000000,
+        "VK_TOKEN": "TOKEN",
+        "VK_GROUP_ID": 1,
+        "TWITTER_CONSUMER_KEY": "TOKEN",
+        "TWITTER_CONSUMER_SECRET": "TOKEN",
+        "TWITTER_ACCESS_TOKEN": "TOKEN",
+        "TWITTER_ACCESS_SECRET": "TOKEN",
+        "TUMBLR_CONSUMER_KEY": "TOKEN",
+        "TUMBLR_CONSUMER_SECRET": "TOKEN",
+        "TUMBLR_ACCESS_TOKEN": "TOKEN",
+        "TUMBLR_ACCESS_SECRET": "TOKEN",
+        "BLUESKY_LOGIN": "benchmark.bsky.social",
+        "BLUESKY_PASSWORD": "PASSWORD",
+    }
+    config = {
+        "admins": "1",
+        "TG_BOT_TOKEN": TOKEN,
+        "profiles": {PROFILE: credentials},
+        # Every post has to upload its media, otherwise only the first one would measure anything
+        "upload_cache": {"enabled": False},
+    }
+    with open(os.path.join(directory, "config.yaml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f)
+
+def connect_clients(main, mock: MockNetworks):
+    import requests
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    class MockAdapter(requests.adapters.HTTPAdapter):
+        # SDKs that hardcode https://host/... are sent to http://mock/host/... instead
+        def send(self, request, **kwargs):
+            parts = urlsplit(request.url)
+            request.url = f"{mock.base_url}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+            return super().send(request, **kwargs)
+
+    main.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f"{mock.base_url}/telegram"))
+
+    clients = main.client_registry.get(PROFILE)
+    adapter = MockAdapter(pool_maxsize=32)
+    clients.get_vk().http.mount("https://", adapter)
+    twitter_api, twitter_client = clients.get_twitter()
+    twitter_api.session.mount("https://", adapter)
+    twitter_client.session.mount("https://", adapter)
+    clients.get_tumblr().request.host = f"{mock.base_url}/api.tumblr.com"
+    bluesky_api = main.atproto_client.Client(base_url=f"{mock.base_url}/bsky/xrpc")
+    clients.login_bluesky(bluesky_api)
+    clients.bluesky_api = bluesky_api
+
+async def publish_post(main, mock: MockNetworks, networks: list[str], media_count: int, side: int) -> dict:
+    draft_id = uuid.uuid4().hex
+    staging = main.media_stagings.get(1, 1, draft_id)
+    media = []
+    for _ in range(media_count):
+        file_id = uuid.uuid4().hex
+        mock.files[file_id] = generate_photo(side)
+        media.append({"file_id": file_id, "type": "photo", "path": staging.reserve_path(".jpg")})
+    post = {
+        "chat_id": 1, "user_id": 1, "draft_id": draft_id, "profile": PROFILE, "networks": networks,
+        "russian_text": "Бенчмарк https://example.com", "english_text": "Benchmark https://example.com",
+        "tags": "#benchmark", "clean_tags": ["benchmark"], "bsky_tags": ["benchmark"],
+        "twitter_reply_post": None, "bsky_reply_post": None, "media": media,
+    }
+
+    timings = {}
+    failures = set()
+    started = time.perf_counter()
+
+    async def on_result(network: str, ok: bool, text: str):
+        timings[network] = time.perf_counter() - started
+        if not ok:
+            failures.add(network)
+            print(text)
+
+    await main.PostPublisher(post).publish(networks, on_result)
+    timings["post"] = time.perf_counter() - started
+
+    await main.media_stagings.discard(1, 1, draft_id)
+    for item in media:
+        mock.files.pop(item["file_id"], None)
+    return {"timings": timings, "failures": failures}
+
+async def run_case(main, mock: MockNetworks, args, media_count: int, side: int) -> dict:
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def run_one():
+        async with slots:
+            return await publish_post(main, mock, args.networks, media_count, side)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run_one() for _ in range(args.posts)))
+    return {"results": results, "elapsed": time.perf_counter() - started}
+
+def print_case(media_count: int, side: int, case: dict, networks: list[str]):
+    results = case["results"]
+    throughput = len(results) / case["elapsed"]
+    print(f"\n{media_count} photos of {side}px, {len(results)} posts, {throughput:.2f} posts/s")
+    print(f"  {'':10} {'p50':>9} {'p99':>9} {'failed':>7}")
+    for name in networks + ["post"]:
+        values = [result["timings"][name] for result in results if name in result["timings"]]
+        failed = sum(name in result["failures"] for result in results)
+        if name == "post":
+            failed = sum(bool(result["failures"]) for result in results)
+        print(f"  {name:10} {percentile(values, 50):8.3f}s {percentile(values, 99):8.3f}s {failed:7}")
+
+async def run_benchmark(main, mock: MockNetworks, args):
+    await asyncio.to_thread(connect_clients, main, mock)
+    # Logging in is done once per process, errors and rate limits only apply to publishing
+    mock.faults_enabled = True
+    print(f"Publishing to {', '.join(args.networks)} through {mock.base_url}, "
+          f"latency {args.latency}±{args.jitter}ms, error rate {args.error_rate}, rate limit {args.rate_limit or 'off'}")
+    try:
+        for media_count in args.media_counts:
+            for side in (args.media_sides if media_count else [0]):
+                case = await run_case(main, mock, args, media_count, side)
+                print_case(media_count, side, case, args.networks)
+    finally:
+        await main.bot.session.close()
+
+def parse_list(value: str, item_type=int) -> list:
+    return [item_type(item) for item in value.split(",") if item]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Publishes posts to local stand-ins of every network and reports latency")
+    parser.add_argument("--posts", type=int, default=20, help="posts per case")
+    parser.add_argument("--concurrency", type=int, default=1, help="posts published at the same time")
+    parser.add_argument("--networks", type=lambda value: parse_list(value, str), default=NETWORKS)
+    parser.add_argument("--media-counts", type=parse_list, default=[0, 1, 4], help="photos per post, e.g. 0,1,4")
+    parser.add_argument("--media-sides", type=parse_list, default=[1024, 4096], help="photo sides in pixels")
+    parser.add_argument("--latency", type=float, default=50, help="milliseconds every stand-in waits before answering")
+    parser.add_argument("--jitter", type=float, default=20, help="random milliseconds added to or taken from latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with a server error")
+    parser.add_argument("--rate-limit", type=float, default=0, help="requests per second each stand-in accepts")
+    args = parser.parse_args()
+    unknown = set(args.networks) - set(NETWORKS)
+    if unknown:
+        parser.error(f"unknown networks: {', '.join(sorted(unknown))}")
+    return args
+
+def main():
+    args = parse_args()
+
+    # main.py reads config.yaml and keeps its databases and media in the working directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory)
+        os.chdir(directory)
+        bot_main = importlib.import_module("main")
+        mock = MockNetworks(args.latency / 1000, args.jitter / 1000, args.error_rate, args.rate_limit,
+                            bot_main.TokenBucket)
+        mock.start()
+        try:
+            asyncio.run(run_benchmark(bot_main, mock, args))
+        finally:
+            bot_main.client_registry.close()
+            bot_main.network_executor.shutdown()
+            bot_main.media_processor.shutdown()
+            mock.stop()
+
+if __name__ == "__main__":
+    main()
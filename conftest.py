@@ -0,0 +1,37 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+# main.py reads config.yaml from the working directory on import and keeps its databases and media there
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix="multiposting-bot-tests-")
+
+CONFIG = {
+    "admins": "1",
+    "TG_BOT_TOKEN": "123456:TEST",
+    "profiles": {
+        "test": {
+            "TWITTER_CONSUMER_KEY": "TOKEN",
+            "TWITTER_CONSUMER_SECRET": "TOKEN",
+            "TWITTER_ACCESS_TOKEN": "TOKEN",
+            "TWITTER_ACCESS_SECRET": "TOKEN",
+        },
+    },
+    "webhook": {"secret_token": "SECRET", "max_concurrent_updates": 2, "drain_timeout": 1},
+    # A failed step fails right away instead of waiting for backoff
+    "retry": {"attempts": 1},
+    "telegram": {"rate_limit": {"enabled": False}},
+    "twitter": {"chunk_size": 4},
+}
+
+with open(os.path.join(WORKDIR, "config.yaml"), "w", encoding="utf-8") as f:
+    yaml.safe_dump(CONFIG, f)
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+
+def pytest_sessionfinish(session, exitstatus):
+    os.chdir(ROOT)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
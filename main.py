@@ -1,31 +1,160 @@
+import time
+
+# Startup time is measured from here, so a slow import added to module level shows up in the log
+STARTUP_STARTED_AT = time.perf_counter()
+
+import asyncio
+import bisect
+import hashlib
+import heapq
+import importlib
+import io
+import json
 import mimetypes
+import mmap
+import multiprocessing
 import os
+import random
 import re
+import shutil
+import sqlite3
+import struct
+import subprocess
+import traceback
+import uuid
 from asyncio import Lock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, fields
+from datetime import datetime
+from functools import cache, partial
 from enum import Enum
-from typing import Any, TypedDict, Tuple, List
+from typing import Any, Tuple, List
+from zoneinfo import ZoneInfo
 
-import pytumblr
-import requests
-import tweepy
-import vk_api
 import yaml
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.filters import Command, BaseFilter
 from aiogram.fsm.scene import SceneRegistry, Scene, on, After
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.methods import SendMediaGroup, TelegramMethod
 from aiogram.types import (
     Message,
-    InlineKeyboardButton, CallbackQuery, FSInputFile,
+    InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, FSInputFile, ErrorEvent,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.utils.media_group import MediaGroupBuilder
-from atproto_client import Client, models
-from atproto_identity import resolver
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import ClientError, ClientResponseError, web
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+class LazyModule:
+    # Network SDKs are imported on first use, atproto's model tree alone takes seconds to load
+    def __init__(self, name: str):
+        self.name = name
+        self.module = None
+        self.load_time = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.module is not None
+
+    def load(self):
+        if self.module is None:
+            started = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            self.load_time = time.perf_counter() - started
+        return self.module
+
+    def __getattr__(self, name: str):
+        return getattr(self.load(), name)
+
+pytumblr = LazyModule("pytumblr")
+requests = LazyModule("requests")
+tweepy = LazyModule("tweepy")
+vk_api = LazyModule("vk_api")
+atproto_client = LazyModule("atproto_client")
+models = LazyModule("atproto_client.models")
+atproto_exceptions = LazyModule("atproto_client.exceptions")
+resolver = LazyModule("atproto_identity.resolver")
 
 with open('config.yaml', 'r', encoding='utf-8') as f:
     config = yaml.safe_load(f)
 
 TOKEN = config["TG_BOT_TOKEN"]
+STARTUP_BUDGET = config.get("startup_budget", 5)
+DATABASE = config.get("database", "bot.sqlite3")
+
+PUBLISH_SETTINGS = config.get("publish") or {}
+PUBLISH_CONCURRENTLY = PUBLISH_SETTINGS.get("concurrent", True)
+NETWORK_TIMEOUT = PUBLISH_SETTINGS.get("network_timeout", 300)
+PUBLISH_DEADLINE = PUBLISH_SETTINGS.get("deadline", 900)
+QUEUE_WORKERS = PUBLISH_SETTINGS.get("workers", 2)
+PUBLISH_DRAIN_TIMEOUT = PUBLISH_SETTINGS.get("drain_timeout", 60)
+STATUS_DEBOUNCE = PUBLISH_SETTINGS.get("status_debounce", 2)
+
+RUN_MODE = config.get("mode", "polling")
+WEBHOOK_SETTINGS = config.get("webhook") or {}
+WEBHOOK_URL = WEBHOOK_SETTINGS.get("url")
+WEBHOOK_PATH = WEBHOOK_SETTINGS.get("path", "/webhook")
+WEBHOOK_HOST = WEBHOOK_SETTINGS.get("host", "0.0.0.0")
+WEBHOOK_PORT = WEBHOOK_SETTINGS.get("port", 8080)
+WEBHOOK_SECRET_TOKEN = WEBHOOK_SETTINGS.get("secret_token")
+WEBHOOK_MAX_CONCURRENT_UPDATES = WEBHOOK_SETTINGS.get("max_concurrent_updates", 20)
+WEBHOOK_DRAIN_TIMEOUT = WEBHOOK_SETTINGS.get("drain_timeout", 30)
+
+SCHEDULE_SETTINGS = config.get("schedule") or {}
+SCHEDULE_TIMEZONE = ZoneInfo(SCHEDULE_SETTINGS.get("timezone", "UTC"))
+SCHEDULE_FORMAT = "%Y-%m-%d %H:%M"
+SCHEDULE_FORMAT_HINT = "YYYY-MM-DD HH:MM"
+
+EXECUTOR_SETTINGS = config.get("executor") or {}
+EXECUTOR_CALL_TIMEOUT = EXECUTOR_SETTINGS.get("call_timeout", 120)
+EXECUTOR_REQUEST_TIMEOUT = EXECUTOR_SETTINGS.get("request_timeout", 60)
+EXECUTOR_WORKERS = EXECUTOR_SETTINGS.get("workers") or {}
+EXECUTOR_DEFAULT_WORKERS = 4
+
+RETRY_SETTINGS = config.get("retry") or {}
+
+METRICS_SETTINGS = config.get("metrics") or {}
+METRICS_ENABLED = METRICS_SETTINGS.get("enabled", False)
+METRICS_HOST = METRICS_SETTINGS.get("host", "127.0.0.1")
+METRICS_PORT = METRICS_SETTINGS.get("port", 9100)
+METRICS_LOOP_LAG_INTERVAL = METRICS_SETTINGS.get("loop_lag_interval", 0.5)
+
+CLIENTS_SETTINGS = config.get("clients") or {}
+CLIENT_IDLE_TTL = CLIENTS_SETTINGS.get("idle_ttl", 1800)
+CLIENT_WARMUP = CLIENTS_SETTINGS.get("warmup", False)
+BLUESKY_SESSION_DIR = CLIENTS_SETTINGS.get("bluesky_session_dir", "sessions")
+
+IDENTITY_CACHE_SETTINGS = config.get("identity_cache") or {}
+IDENTITY_CACHE_TTL = IDENTITY_CACHE_SETTINGS.get("ttl", 86400)
+IDENTITY_CACHE_FILE = IDENTITY_CACHE_SETTINGS.get("file")
+
+TELEGRAM_RATE_LIMIT = (config.get("telegram") or {}).get("rate_limit") or {}
+TELEGRAM_RATE_LIMIT_ENABLED = TELEGRAM_RATE_LIMIT.get("enabled", True)
+TELEGRAM_GLOBAL_PER_SECOND = TELEGRAM_RATE_LIMIT.get("global_per_second", 30)
+TELEGRAM_CHAT_PER_SECOND = TELEGRAM_RATE_LIMIT.get("chat_per_second", 1)
+TELEGRAM_CHAT_BURST = TELEGRAM_RATE_LIMIT.get("chat_burst", 5)
+TELEGRAM_GROUP_PER_MINUTE = TELEGRAM_RATE_LIMIT.get("group_per_minute", 20)
+TELEGRAM_MAX_RETRY_AFTER = TELEGRAM_RATE_LIMIT.get("max_retry_after", 60)
+TELEGRAM_RETRY_AFTER_ATTEMPTS = TELEGRAM_RATE_LIMIT.get("retry_after_attempts", 3)
+
+TWITTER_SETTINGS = config.get("twitter") or {}
+TWITTER_UPLOAD_HOST = TWITTER_SETTINGS.get("upload_host", "upload.twitter.com")
+TWITTER_CHUNK_SIZE = TWITTER_SETTINGS.get("chunk_size", 4 * 1024 * 1024)
+TWITTER_UPLOAD_CONCURRENCY = TWITTER_SETTINGS.get("upload_concurrency", 2)
+TWITTER_MAX_CHUNK_SIZE = 5 * 1024 * 1024
+TWITTER_MAX_SEGMENTS = 1000
+
+UPLOAD_CACHE_SETTINGS = config.get("upload_cache") or {}
+UPLOAD_CACHE_ENABLED = UPLOAD_CACHE_SETTINGS.get("enabled", True)
+UPLOAD_CACHE_MAX_ENTRIES = UPLOAD_CACHE_SETTINGS.get("max_entries", 5000)
+UPLOAD_CACHE_TTL = UPLOAD_CACHE_SETTINGS.get("ttl", 30 * 86400)
+UPLOAD_CACHE_PENDING_BLOB_TTL = UPLOAD_CACHE_SETTINGS.get("pending_blob_ttl", 3600)
+UPLOAD_CACHE_TWITTER_MARGIN = 600
 
 BUTTON_CANCEL = InlineKeyboardButton(text="✖️ Cancel", callback_data="cancel")
 BUTTON_BACK = InlineKeyboardButton(text="🔙 Back", callback_data="back")
@@ -33,8 +162,15 @@ BUTTON_BACK = InlineKeyboardButton(text="🔙 Back", callback_data="back")
 router = Router(name=__name__)
 bot = Bot(token=TOKEN)
 
-MEDIA_DIR = "media"
-download_lock = Lock()
+MEDIA_SETTINGS = config.get("media") or {}
+MEDIA_DIR = MEDIA_SETTINGS.get("dir", "media")
+DRAFT_TTL = MEDIA_SETTINGS.get("draft_ttl", 86400)
+MEDIA_SWEEP_INTERVAL = MEDIA_SETTINGS.get("sweep_interval", 3600)
+ALBUM_DELAY = MEDIA_SETTINGS.get("album_delay", 0.5)
+MEDIA_PREFETCH = MEDIA_SETTINGS.get("prefetch", True)
+MEDIA_PROCESSES = MEDIA_SETTINGS.get("processes")
+MEDIA_CACHE_DIR = MEDIA_SETTINGS.get("cache_dir", "media_cache")
+MEDIA_CACHE_TTL = MEDIA_SETTINGS.get("cache_ttl", 7 * 86400)
 
 class Networks(Enum):
     Telegram = 0
@@ -44,6 +180,663 @@ class Networks(Enum):
     Bluesky = 4
 SOCIAL_NETWORKS = [Networks.Telegram.name, Networks.VK.name, Networks.Twitter.name, Networks.Tumblr.name, Networks.Bluesky.name]
 
+@dataclass(frozen=True)
+class NetworkPublisher:
+    credential: str  # a profile uses the network when this setting is filled in
+    upload: str      # PostPublisher method that publishes the post
+    sdks: tuple[LazyModule, ...] = ()
+
+NETWORK_PUBLISHERS = {
+    Networks.Telegram: NetworkPublisher("TG_CHANNEL_ID", "upload_to_tg"),
+    Networks.VK: NetworkPublisher("VK_TOKEN", "upload_to_vk", (vk_api,)),
+    Networks.Twitter: NetworkPublisher("TWITTER_ACCESS_TOKEN", "upload_to_twitter", (requests, tweepy)),
+    Networks.Tumblr: NetworkPublisher("TUMBLR_ACCESS_TOKEN", "upload_to_tumblr", (pytumblr,)),
+    Networks.Bluesky: NetworkPublisher("BLUESKY_LOGIN", "upload_to_bsky",
+                                       (atproto_client, models, atproto_exceptions, resolver)),
+}
+
+def load_network_sdks(profiles: dict) -> dict[Networks, float]:
+    # Networks that no profile is configured for keep their SDKs unloaded until something asks for them
+    load_times = {}
+    for network, publisher in NETWORK_PUBLISHERS.items():
+        if publisher.sdks and any(settings.get(publisher.credential) for settings in profiles.values()):
+            for sdk in publisher.sdks:
+                sdk.load()
+            load_times[network] = sum(sdk.load_time or 0 for sdk in publisher.sdks)
+    return load_times
+
+MB = 1024 * 1024
+# Telegram reuses file_ids, every other network gets a variant that fits its upload limits
+MEDIA_LIMITS = {
+    Networks.VK.name: {"image_bytes": 50 * MB, "image_side": 7000, "video_bytes": 256 * MB, "video_side": 1920,
+                       "video_duration": 3600},
+    Networks.Twitter.name: {"image_bytes": 5 * MB, "image_side": 4096, "video_bytes": 512 * MB, "video_side": 1920,
+                            "video_duration": 140},
+    Networks.Tumblr.name: {"image_bytes": 20 * MB, "image_side": 4096, "video_bytes": 500 * MB, "video_side": 1920,
+                           "video_duration": 600},
+    Networks.Bluesky.name: {"image_bytes": 1000000, "image_side": 2000, "video_bytes": 100 * MB, "video_side": 1920,
+                            "video_duration": 180},
+}
+IMAGE_QUALITIES = [90, 85, 80, 70, 60, 50]
+
+class ExecutorTimeoutError(TimeoutError):
+    pass
+
+class NetworkExecutor:
+    def __init__(self, workers: dict[str, int], call_timeout: float | None):
+        self.workers = workers
+        self.call_timeout = call_timeout
+        self.pools: dict[Networks, ThreadPoolExecutor] = {}
+
+    def get_pool(self, network: Networks) -> ThreadPoolExecutor:
+        pool = self.pools.get(network)
+        if pool is None:
+            pool = ThreadPoolExecutor(
+                max_workers=self.workers.get(network.name, EXECUTOR_DEFAULT_WORKERS),
+                thread_name_prefix=f"{network.name.lower()}-sdk",
+            )
+            self.pools[network] = pool
+        return pool
+
+    async def run(self, network: Networks, func, *args, **kwargs):
+        # The timeout only stops waiting, the thread is freed when the SDK's own request timeout fires
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.get_pool(network), partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout=self.call_timeout)
+        except asyncio.TimeoutError:
+            raise ExecutorTimeoutError(f"{network.name} call {getattr(func, '__name__', func)} timed out after {self.call_timeout}s")
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.pools.clear()
+
+network_executor = NetworkExecutor(EXECUTOR_WORKERS, EXECUTOR_CALL_TIMEOUT)
+
+class TumblrApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Tumblr API error {status}: {message}")
+        self.status = status
+
+def call_tumblr(func, *args, **kwargs):
+    # pytumblr returns error responses instead of raising them
+    response = func(*args, **kwargs)
+    if isinstance(response, dict) and "meta" in response and response["meta"].get("status", 200) >= 400:
+        raise TumblrApiError(response["meta"]["status"], response["meta"].get("msg", ""))
+    return response
+
+VK_RATE_LIMIT_ERROR_CODES = {6, 9, 29}
+VK_TRANSIENT_ERROR_CODES = {1, 10}
+
+def get_retry_after(headers) -> float | None:
+    if not headers:
+        return None
+    try:
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            return float(retry_after)
+        reset = headers.get("x-rate-limit-reset") or headers.get("ratelimit-reset")
+        if reset is not None:
+            return max(float(reset) - time.time(), 0)
+    except ValueError:
+        pass
+    return None
+
+def classify_error(e: BaseException) -> tuple[str, float | None]:
+    # "rate_limit" means the request was rejected before doing anything, so even posting is safe to repeat
+    if isinstance(e, ExecutorTimeoutError):
+        # The abandoned call is still running in its thread, a retry would upload the same thing twice
+        return "timeout", None
+    if isinstance(e, TelegramRetryAfter):
+        return "rate_limit", e.retry_after
+    if isinstance(e, (TelegramNetworkError, TelegramServerError)):
+        return "transient", None
+    # Files are downloaded from Telegram outside the Bot API, its errors come straight from aiohttp
+    if isinstance(e, ClientResponseError):
+        if e.status == 429:
+            return "rate_limit", get_retry_after(e.headers)
+        return ("transient" if e.status >= 500 else "permanent"), None
+    if isinstance(e, ClientError):
+        return "transient", None
+    # An SDK that was never loaded can't have raised anything, checking it would only import it
+    if tweepy.loaded:
+        if isinstance(e, tweepy.TooManyRequests):
+            return "rate_limit", get_retry_after(e.response.headers)
+        if isinstance(e, tweepy.TwitterServerError):
+            return "transient", None
+        if isinstance(e, tweepy.HTTPException):
+            return "permanent", None
+    if vk_api.loaded:
+        if isinstance(e, vk_api.ApiError):
+            if e.code in VK_RATE_LIMIT_ERROR_CODES:
+                return "rate_limit", None
+            return ("transient" if e.code in VK_TRANSIENT_ERROR_CODES else "permanent"), None
+        if isinstance(e, vk_api.ApiHttpError):
+            return "transient", None
+    if atproto_exceptions.loaded:
+        if isinstance(e, atproto_exceptions.NetworkError):
+            return "transient", None
+        if isinstance(e, atproto_exceptions.RequestErrorBase) and e.response is not None:
+            if e.response.status_code == 429:
+                return "rate_limit", get_retry_after(e.response.headers)
+            return ("transient" if e.response.status_code >= 500 else "permanent"), None
+    if isinstance(e, TumblrApiError):
+        if e.status == 429:
+            return "rate_limit", None
+        return ("transient" if e.status >= 500 else "permanent"), None
+    if requests.loaded:
+        if isinstance(e, requests.HTTPError) and e.response is not None:
+            if e.response.status_code == 429:
+                return "rate_limit", get_retry_after(e.response.headers)
+            return ("transient" if e.response.status_code >= 500 else "permanent"), None
+        if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+            return "transient", None
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return "transient", None
+    return "permanent", None
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    parts = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple, Any] = {}
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), collect=None):
+        super().__init__(name, description, labels)
+        # Values that are cheap to read at scrape time aren't tracked on every change
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self) -> list[str]:
+        if self.collect is not None:
+            self.values = self.collect()
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[key] = (counts, total + value)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self, host: str, port: int, loop_lag_interval: float):
+        self.host = host
+        self.port = port
+        self.loop_lag_interval = loop_lag_interval
+        self.metrics: list[Metric] = []
+        self.runner = None
+        self.lag_task = None
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Prometheus picks the text exposition format by the version parameter
+        return web.Response(text=self.render(), headers={
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+            "X-Content-Type-Options": "nosniff",
+        })
+
+    async def measure_loop_lag(self):
+        # A sleep that wakes up late means callbacks were blocking the loop for that long
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.loop_lag_interval)
+            lag = max(loop.time() - started - self.loop_lag_interval, 0)
+            event_loop_lag.observe(lag)
+            event_loop_lag_last.set(lag)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.lag_task = asyncio.create_task(self.measure_loop_lag())
+        print(f"Metrics are served on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+            await asyncio.gather(self.lag_task, return_exceptions=True)
+            self.lag_task = None
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics = MetricsRegistry(METRICS_HOST, METRICS_PORT, METRICS_LOOP_LAG_INTERVAL)
+publish_duration = metrics.add(Histogram(
+    "bot_publish_duration_seconds", "Time to publish a post to one network", ("network", "profile", "result")))
+post_publish_duration = metrics.add(Histogram(
+    "bot_post_publish_duration_seconds", "Time to publish a post to all chosen networks", ("profile",)))
+publish_failures = metrics.add(Counter(
+    "bot_publish_failures_total", "Posts that failed on a network", ("network", "profile", "kind", "error")))
+uploaded_bytes = metrics.add(Counter(
+    "bot_uploaded_bytes_total", "Media bytes sent to a network", ("network", "profile")))
+retries = metrics.add(Counter(
+    "bot_retries_total", "Calls repeated after an error", ("network", "kind", "error")))
+media_download_duration = metrics.add(Histogram(
+    "bot_media_download_duration_seconds", "Time to download one media file from Telegram"))
+downloaded_bytes = metrics.add(Counter(
+    "bot_media_downloaded_bytes_total", "Media bytes downloaded from Telegram"))
+handler_errors = metrics.add(Counter(
+    "bot_handler_errors_total", "Exceptions that reached the global error handler", ("error",)))
+event_loop_lag = metrics.add(Histogram(
+    "bot_event_loop_lag_seconds", "How late the event loop wakes up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)))
+telegram_throttle_duration = metrics.add(Histogram(
+    "bot_telegram_throttle_seconds", "Time a Bot API request waited for the rate limiter", ("priority",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)))
+event_loop_lag_last = metrics.add(Gauge(
+    "bot_event_loop_lag_last_seconds", "Event loop lag at the last check"))
+
+class RetryStats:
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        self.waited = 0.0
+
+    def __str__(self):
+        return f"{self.retries} retries in {self.attempts} attempts, waited {self.waited:.1f}s"
+
+class RetryPolicy:
+    def __init__(self, network: Networks, attempts: int, base_delay: float, max_delay: float):
+        self.network = network
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def for_network(cls, network: Networks) -> "RetryPolicy":
+        settings = {**RETRY_SETTINGS, **(RETRY_SETTINGS.get("networks") or {}).get(network.name, {})}
+        return cls(network, settings.get("attempts", 4), settings.get("base_delay", 1), settings.get("max_delay", 60))
+
+    def get_delay(self, attempt: int, retry_after: float | None) -> float | None:
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            return retry_after + random.uniform(0, self.base_delay)
+        # Full jitter keeps several branches hitting the same API from retrying in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, stats: RetryStats, func, *args, idempotent: bool = True, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            stats.attempts += 1
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if isinstance(e, TelegramRetryAfter) and telegram_rate_limiter.installed:
+                    # The rate limiter has already waited out the flood control as many times as allowed
+                    raise
+                kind, retry_after = classify_error(e)
+                retryable = kind == "rate_limit" or (kind == "transient" and idempotent)
+                delay = self.get_delay(attempt, retry_after) if retryable and attempt < self.attempts else None
+                if delay is None:
+                    raise
+                retries.inc(network=self.network.name, kind=kind, error=type(e).__name__)
+                print(f"Retrying {getattr(func, '__name__', func)} in {delay:.1f}s after {type(e).__name__}: {e}")
+
+            for arg in (*args, *kwargs.values()):
+                # Streamed media must be sent from the beginning again
+                if isinstance(arg, io.IOBase) and arg.seekable():
+                    arg.seek(0)
+            stats.retries += 1
+            stats.waited += delay
+            await asyncio.sleep(delay)
+
+class IdentityCache:
+    def __init__(self, ttl: float, path: str | None):
+        self.ttl = ttl
+        self.path = path
+        self.entries: dict[str, tuple[float, Any]] = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = {key: (expires_at, value) for key, (expires_at, value) in json.load(f).items()}
+        except Exception as e:
+            print(f"Error loading identity cache {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error saving identity cache {self.path}: {e}")
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.time() >= expires_at:
+            del self.entries[key]
+            return None
+        return value
+
+    def set(self, key: str, value):
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.save()
+
+    async def get_or_fetch(self, key: str, fetch):
+        value = self.get(key)
+        if value is None:
+            value = await fetch()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, scope: str | None = None) -> int:
+        if scope is None:
+            keys = list(self.entries)
+        else:
+            keys = [key for key in self.entries if key.split(":", 1)[1] == scope]
+        for key in keys:
+            del self.entries[key]
+        self.save()
+        return len(keys)
+
+identity_cache = IdentityCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_FILE)
+
+@cache
+def use_tumblr_timeout_session():
+    # pytumblr sends every request through requests.get/post, a shared session in their place adds the timeout
+    pytumblr.request.requests = get_timeout_session_class()()
+
+@cache
+def get_bluesky_resolver():
+    return resolver.IdResolver()
+
+async def resolve_bluesky_handle(handle: str) -> str | None:
+    async def fetch():
+        return await network_executor.run(Networks.Bluesky, lambda: get_bluesky_resolver().handle.resolve(handle))
+
+    return await identity_cache.get_or_fetch(f"bluesky_did:{handle}", fetch)
+
+@cache
+def get_timeout_session_class():
+    class TimeoutSession(requests.Session):
+        # requests waits forever by default, a hung connection would keep its executor thread busy for good
+        def request(self, *args, **kwargs):
+            if kwargs.get("timeout") is None:
+                kwargs["timeout"] = EXECUTOR_REQUEST_TIMEOUT
+            return super().request(*args, **kwargs)
+
+    return TimeoutSession
+
+@cache
+def get_keep_alive_session_class():
+    class KeepAliveSession(get_timeout_session_class()):
+        # tweepy.API closes its session after every request, which throws away the pooled connections
+        def close(self):
+            pass
+
+        def shutdown(self):
+            super().close()
+
+    return KeepAliveSession
+
+class BlueskySessionStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def get_path(self, profile: str) -> str:
+        return os.path.join(self.directory, f"bluesky_{profile}.session")
+
+    def has(self, profile: str) -> bool:
+        return os.path.isfile(self.get_path(profile))
+
+    def load(self, profile: str) -> str | None:
+        try:
+            with open(self.get_path(profile), "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def save(self, profile: str, session_string: str):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(profile)
+        temp_path = f"{path}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(session_string)
+        os.replace(temp_path, path)
+
+    def remove(self, profile: str):
+        try:
+            os.remove(self.get_path(profile))
+        except FileNotFoundError:
+            pass
+
+bluesky_sessions = BlueskySessionStore(BLUESKY_SESSION_DIR)
+
+class ProfileClients:
+    def __init__(self, profile: str, settings: dict):
+        self.profile = profile
+        self.settings = settings
+        self.last_used = time.monotonic()
+        self.vk_session = None
+        self.twitter_api = None
+        self.twitter_client = None
+        self.tumblr_api = None
+        self.bluesky_api = None
+        self.bluesky_lock = Lock()
+
+    def has_network(self, network: Networks) -> bool:
+        return bool(self.settings.get(NETWORK_PUBLISHERS[network].credential))
+
+    def get_vk(self):
+        if self.vk_session is None:
+            session = get_timeout_session_class()()
+            session.headers["User-agent"] = vk_api.vk_api.DEFAULT_USERAGENT
+            self.vk_session = vk_api.VkApi(token=self.settings["VK_TOKEN"], session=session)
+        return self.vk_session
+
+    def get_twitter(self):
+        if self.twitter_api is None:
+            twitter_auth = tweepy.OAuth1UserHandler(
+                self.settings["TWITTER_CONSUMER_KEY"],
+                self.settings["TWITTER_CONSUMER_SECRET"],
+                self.settings["TWITTER_ACCESS_TOKEN"],
+                self.settings["TWITTER_ACCESS_SECRET"]
+            )
+            self.twitter_api = tweepy.API(twitter_auth, upload_host=TWITTER_UPLOAD_HOST,
+                                          timeout=EXECUTOR_REQUEST_TIMEOUT)
+            self.twitter_api.session = get_keep_alive_session_class()()
+
+            self.twitter_client = tweepy.Client(consumer_key=self.settings["TWITTER_CONSUMER_KEY"],
+                                                consumer_secret=self.settings["TWITTER_CONSUMER_SECRET"],
+                                                access_token=self.settings["TWITTER_ACCESS_TOKEN"],
+                                                access_token_secret=self.settings["TWITTER_ACCESS_SECRET"])
+            self.twitter_client.session = get_timeout_session_class()()
+        return self.twitter_api, self.twitter_client
+
+    def get_tumblr(self):
+        if self.tumblr_api is None:
+            use_tumblr_timeout_session()
+            self.tumblr_api = pytumblr.TumblrRestClient(
+                self.settings["TUMBLR_CONSUMER_KEY"],
+                self.settings["TUMBLR_CONSUMER_SECRET"],
+                self.settings["TUMBLR_ACCESS_TOKEN"],
+                self.settings["TUMBLR_ACCESS_SECRET"]
+            )
+        return self.tumblr_api
+
+    def login_bluesky(self, bluesky_api: "atproto_client.Client"):
+        session_string = bluesky_sessions.load(self.profile)
+        if session_string:
+            try:
+                # Expired access tokens are refreshed by the client itself while restoring
+                bluesky_api.login(session_string=session_string)
+                return
+            except Exception as e:
+                print(f"Stored Bluesky session for {self.profile} can't be restored, logging in again: {e}")
+                bluesky_sessions.remove(self.profile)
+
+        bluesky_api.login(self.settings["BLUESKY_LOGIN"], self.settings["BLUESKY_PASSWORD"])
+
+    async def get_bluesky(self):
+        async with self.bluesky_lock:
+            if self.bluesky_api is None:
+                bluesky_api = atproto_client.Client(
+                    request=atproto_client.request.Request(timeout=EXECUTOR_REQUEST_TIMEOUT)
+                )
+                bluesky_api.on_session_change(
+                    lambda event, session: bluesky_sessions.save(self.profile, session.encode())
+                )
+                await network_executor.run(Networks.Bluesky, self.login_bluesky, bluesky_api)
+                self.bluesky_api = bluesky_api
+        return self.bluesky_api
+
+    async def get_twitter_username(self) -> str:
+        async def fetch():
+            _, client = self.get_twitter()
+            my_twitter = await network_executor.run(Networks.Twitter, client.get_me, user_auth=True)
+            return my_twitter.data["username"]
+
+        return await identity_cache.get_or_fetch(f"twitter_username:{self.profile}", fetch)
+
+    async def get_tumblr_blog_name(self) -> str:
+        async def fetch():
+            tumblr_info = await network_executor.run(Networks.Tumblr, call_tumblr, self.get_tumblr().info)
+            return tumblr_info["user"]["name"]
+
+        return await identity_cache.get_or_fetch(f"tumblr_blog:{self.profile}", fetch)
+
+    async def warm_up(self):
+        if self.has_network(Networks.VK):
+            vk = self.get_vk().get_api()
+            await network_executor.run(Networks.VK, vk.groups.getById, group_id=self.settings["VK_GROUP_ID"])
+        if self.has_network(Networks.Twitter):
+            await self.get_twitter_username()
+        if self.has_network(Networks.Tumblr):
+            await self.get_tumblr_blog_name()
+        if self.has_network(Networks.Bluesky):
+            await self.get_bluesky()
+
+    def close(self):
+        if self.vk_session is not None:
+            self.vk_session.http.close()
+        if self.twitter_api is not None:
+            self.twitter_api.session.shutdown()
+            self.twitter_client.session.close()
+        if self.bluesky_api is not None:
+            self.bluesky_api.request.close()
+
+class ClientRegistry:
+    def __init__(self, profiles: dict, idle_ttl: float):
+        self.profiles = profiles
+        self.idle_ttl = idle_ttl
+        self.clients: dict[str, ProfileClients] = {}
+
+    def get(self, profile: str) -> ProfileClients:
+        self.evict_idle()
+        clients = self.clients.get(profile)
+        if clients is None:
+            clients = ProfileClients(profile, self.profiles[profile])
+            self.clients[profile] = clients
+        clients.last_used = time.monotonic()
+        return clients
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for profile, clients in list(self.clients.items()):
+            if now - clients.last_used > self.idle_ttl:
+                del self.clients[profile]
+                clients.close()
+
+    async def warm_up(self):
+        profiles = list(self.profiles.keys())
+        results = await asyncio.gather(*(self.get(profile).warm_up() for profile in profiles),
+                                       return_exceptions=True)
+        for profile, result in zip(profiles, results):
+            if isinstance(result, Exception):
+                print(f"Failed to warm up clients for {profile}: {result}")
+
+    async def restore_sessions(self):
+        profiles = [profile for profile in self.profiles if bluesky_sessions.has(profile)]
+        results = await asyncio.gather(*(self.get(profile).get_bluesky() for profile in profiles),
+                                       return_exceptions=True)
+        for profile, result in zip(profiles, results):
+            if isinstance(result, Exception):
+                print(f"Failed to restore Bluesky session for {profile}: {result}")
+
+    def close(self):
+        for clients in self.clients.values():
+            clients.close()
+        self.clients.clear()
+
+client_registry = ClientRegistry(config["profiles"], CLIENT_IDLE_TTL)
+
 def generate_choose_network_keyboard(chosen_networks):
     menu_builder = InlineKeyboardBuilder()
     for network in SOCIAL_NETWORKS:
@@ -67,52 +860,776 @@ def generate_choose_network_keyboard(chosen_networks):
     )
     return menu_builder
 
-async def global_error_handler(update, exception):
-    import traceback
+async def reset_cache_command(message: Message):
+    if str(message.from_user.id) not in config["admins"]:
+        return
+
+    parts = message.text.split(maxsplit=1)
+    scope = parts[1].strip() if len(parts) > 1 else None
+    removed = identity_cache.invalidate(scope)
+    await message.answer(f"Removed {removed} cached identities")
+
+async def global_error_handler(event: ErrorEvent):
+    handler_errors.inc(error=type(event.exception).__name__)
     traceback.print_exc()
     return True
 
-class FSMData(TypedDict, total=False):
-    profile: str
-    profile_settings: Any
-    networks: list[str]
-    russian_text: str
-    english_text: str
-    clean_tags: set[str]
-    tags: str
-    bsky_tags: set[str]
-    answer_message: Message
-    twitter_reply_post: str
-    bsky_reply_post: str
-
-def get_media_next_number():
-    existing = [f for f in os.listdir(MEDIA_DIR) if f.startswith("media_")]
-    numbers = [
-        int(f.split("_")[1].split(".")[0])
-        for f in existing
-        if f.split("_")[1].split(".")[0].isdigit()
-    ]
-    return max(numbers, default=0) + 1
-
-def get_media_files() -> list[str]:
-    if not os.path.exists(MEDIA_DIR):
-        return []
-
-    files = [
-        os.path.join(MEDIA_DIR, f)
-        for f in os.listdir(MEDIA_DIR)
-        if os.path.isfile(os.path.join(MEDIA_DIR, f)) and f.startswith("media_")
-    ]
-    return sorted(files)
-
-def remove_media_files():
-    for filename in os.listdir(MEDIA_DIR):
-        file_path = os.path.join(MEDIA_DIR, filename)
-        if os.path.isfile(file_path):
+class SQLiteStorage(BaseStorage):
+    # Drafts survive restarts, only JSON-serializable state is stored and nothing is kept in memory
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_records (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+        return self.connection
+
+    def write(self, key: StorageKey, column: str, value: str | None):
+        connection = self.connect()
+        record = {"state": None, "data": "{}", column: value}
+        record_key = self.key_builder.build(key)
+        with connection:
+            connection.execute(
+                "INSERT INTO fsm_records (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at",
+                (record_key, record["state"], record["data"], time.time())
+            )
+            # A finished draft leaves nothing behind
+            connection.execute(
+                "DELETE FROM fsm_records WHERE key = ? AND state IS NULL AND data = '{}'",
+                (record_key,)
+            )
+
+    def read(self, key: StorageKey, column: str) -> str | None:
+        row = self.connect().execute(
+            f"SELECT {column} FROM fsm_records WHERE key = ?", (self.key_builder.build(key),)
+        ).fetchone()
+        return row[0] if row else None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self.write(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return self.read(key, "state")
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        self.write(key, "data", json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        data = self.read(key, "data")
+        return json.loads(data) if data else {}
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+@dataclass(slots=True)
+class PostDraft:
+    profile: str = ""
+    networks: list[str] = field(default_factory=list)
+    russian_text: str = ""
+    english_text: str = ""
+    tags: str = ""
+    clean_tags: list[str] = field(default_factory=list)
+    bsky_tags: list[str] = field(default_factory=list)
+    draft_id: str | None = None
+    media: list[dict] = field(default_factory=list)
+    twitter_reply_post: str | None = None
+    bsky_reply_post: str | None = None
+    scheduled_at: float | None = None
+    answer_chat_id: int | None = None
+    answer_message_id: int | None = None
+
+    @classmethod
+    def from_data(cls, data: dict) -> "PostDraft":
+        return cls(**{f.name: data[f.name] for f in fields(cls) if f.name in data})
+
+    def to_data(self) -> dict:
+        return asdict(self)
+
+    def to_post(self, chat_id: int, user_id: int) -> dict:
+        # Publishers get a copy, later edits of the draft don't reach a queued post
+        return {
+            "chat_id": chat_id,
+            "user_id": user_id,
+            # The control message becomes the status message of the post
+            "status_chat_id": self.answer_chat_id,
+            "status_message_id": self.answer_message_id,
+            "draft_id": self.draft_id,
+            "profile": self.profile,
+            "networks": list(self.networks),
+            "russian_text": self.russian_text,
+            "english_text": self.english_text,
+            "tags": self.tags,
+            "clean_tags": list(self.clean_tags),
+            "bsky_tags": list(self.bsky_tags),
+            "twitter_reply_post": self.twitter_reply_post,
+            "bsky_reply_post": self.bsky_reply_post,
+            "media": [dict(media) for media in self.media],
+        }
+
+def get_media_number(filename: str) -> int | None:
+    if not filename.startswith("media_"):
+        return None
+    number = filename.split("_")[1].split(".")[0]
+    return int(number) if number.isdigit() else None
+
+async def download_telegram_file(file_id: str, path: str):
+    # Every network except Telegram fails without the bytes, so fetching them gets the same retries as posting
+    retry_policy = RetryPolicy.for_network(Networks.Telegram)
+    stats = RetryStats()
+    temp_path = f"{path}.part"
+    started = time.perf_counter()
+    file = await retry_policy.call(stats, bot.get_file, file_id=file_id)
+    await retry_policy.call(stats, bot.download_file, file_path=file.file_path, destination=temp_path)
+    media_download_duration.observe(time.perf_counter() - started)
+    downloaded_bytes.inc(os.path.getsize(temp_path))
+    os.replace(temp_path, path)
+
+class MappedMedia:
+    def __init__(self, path: str):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.map = None
+        if self.size:
+            with open(path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def open(self) -> "MappedMediaReader":
+        return MappedMediaReader(self)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class MappedMediaReader(io.RawIOBase):
+    # Every uploader gets its own position over the same shared mapping, pages are loaded by the OS on demand
+    def __init__(self, media: MappedMedia):
+        super().__init__()
+        self.media = media
+        self.name = media.path
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.media.size + offset
+        self.position = max(self.position, 0)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.media.map is None or self.position >= self.media.size:
+            return 0
+        chunk = self.media.map[self.position:self.position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+def iter_boxes(f, start: int, end: int):
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header_size = 8
+        if size == 1:
+            size, = struct.unpack(">Q", f.read(8))
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+def probe_jpeg(f, info: dict):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        code = marker[1]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            continue
+        length, = struct.unpack(">H", f.read(2))
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            _, info["height"], info["width"] = struct.unpack(">BHH", f.read(5))
+            return
+        f.seek(length - 2, io.SEEK_CUR)
+
+HEIC_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx", b"mif1", b"msf1"}
+AVIF_BRANDS = {b"avif", b"avis"}
+
+def get_brand_mime(major: bytes, compatible: list[bytes]) -> str:
+    # HEIC and AVIF photos share the MP4 container, only their brands tell them apart from videos
+    if major == b"qt  ":
+        return "video/quicktime"
+    if major in HEIC_BRANDS | AVIF_BRANDS:
+        # A generic image brand such as mif1 lists the codec among the compatible brands
+        return "image/avif" if AVIF_BRANDS.intersection([major, *compatible]) else "image/heic"
+    return "video/mp4"
+
+def probe_heif_size(f, start: int, end: int, info: dict):
+    # A photo may be stored as tiles, each with its own size, the largest one is the whole image
+    sizes = []
+    # meta is a full box, its children follow the version and flags
+    for box_type, box_start, box_end in iter_boxes(f, start + 4, end):
+        if box_type != b"iprp":
+            continue
+        for child, child_start, child_end in iter_boxes(f, box_start, box_end):
+            if child != b"ipco":
+                continue
+            for prop, prop_start, _ in iter_boxes(f, child_start, child_end):
+                if prop == b"ispe":
+                    f.seek(prop_start + 4)
+                    sizes.append(struct.unpack(">II", f.read(8)))
+    if sizes:
+        info["width"], info["height"] = max(sizes, key=lambda size: size[0] * size[1])
+
+def probe_mp4(f, info: dict):
+    for box_type, start, end in iter_boxes(f, 0, info["size"]):
+        if box_type == b"ftyp":
+            f.seek(start)
+            major = f.read(4)
+            f.seek(start + 8)
+            compatible = [f.read(4) for _ in range((end - start - 8) // 4)]
+            info["mime"] = get_brand_mime(major, compatible)
+        elif box_type == b"meta" and info["mime"].startswith("image/"):
+            probe_heif_size(f, start, end, info)
+        if box_type != b"moov":
+            continue
+        for child, child_start, child_end in iter_boxes(f, start, end):
+            f.seek(child_start)
+            if child == b"mvhd":
+                version = f.read(4)[0]
+                f.seek(16 if version == 1 else 8, io.SEEK_CUR)
+                timescale, duration = struct.unpack(">IQ" if version == 1 else ">II", f.read(12 if version == 1 else 8))
+                if timescale:
+                    info["duration"] = duration / timescale
+            elif child == b"trak" and info["width"] is None:
+                for track_box, track_start, _ in iter_boxes(f, child_start, child_end):
+                    if track_box != b"tkhd":
+                        continue
+                    f.seek(track_start)
+                    version = f.read(1)[0]
+                    f.seek(track_start + (52 if version == 1 else 40))
+                    matrix = struct.unpack(">9i", f.read(36))
+                    width, height = (value >> 16 for value in struct.unpack(">II", f.read(8)))
+                    if width and height:
+                        # Phone videos are stored sideways with a rotation matrix
+                        rotated = matrix[0] == 0 and matrix[1] != 0
+                        info["width"], info["height"] = (height, width) if rotated else (width, height)
+        return
+
+def probe_media(path: str) -> dict:
+    # Only the container headers are read, pixels and frames are never decoded
+    info = {"mime": None, "width": None, "height": None, "duration": None, "size": os.path.getsize(path)}
+    with open(path, "rb") as f:
+        head = f.read(32)
+        try:
+            if head.startswith(b"\x89PNG\r\n\x1a\n"):
+                info["mime"] = "image/png"
+                info["width"], info["height"] = struct.unpack(">II", head[16:24])
+            elif head[:6] in (b"GIF87a", b"GIF89a"):
+                info["mime"] = "image/gif"
+                info["width"], info["height"] = struct.unpack("<HH", head[6:10])
+            elif head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+                info["mime"] = "image/webp"
+                chunk = head[12:16]
+                if chunk == b"VP8 ":
+                    width, height = struct.unpack("<HH", head[26:30])
+                    info["width"], info["height"] = width & 0x3FFF, height & 0x3FFF
+                elif chunk == b"VP8L":
+                    bits, = struct.unpack("<I", head[21:25])
+                    info["width"], info["height"] = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+                elif chunk == b"VP8X":
+                    info["width"] = int.from_bytes(head[24:27], "little") + 1
+                    info["height"] = int.from_bytes(head[27:30], "little") + 1
+            elif head.startswith(b"\xff\xd8\xff"):
+                info["mime"] = "image/jpeg"
+                probe_jpeg(f, info)
+            elif head[4:8] == b"ftyp":
+                probe_mp4(f, info)
+            elif head.startswith(b"\x1a\x45\xdf\xa3"):
+                info["mime"] = "video/webm"
+        except (struct.error, IndexError) as e:
+            print(f"Error probing {path}: {e}")
+
+    if info["mime"] is None:
+        info["mime"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return info
+
+def get_media_limits(network: str) -> dict | None:
+    limits = MEDIA_LIMITS.get(network)
+    if limits is None:
+        return None
+    return {**limits, **((MEDIA_SETTINGS.get("limits") or {}).get(network) or {})}
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(partial(f.read, MB), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_temp_path(path: str) -> str:
+    # Two workers making the same variant at once each write their own file, the last rename wins
+    root, ext = os.path.splitext(path)
+    return f"{root}.{uuid.uuid4().hex}.part{ext}"
+
+def write_variant(path: str, data: bytes):
+    temp_path = get_temp_path(path)
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def encode_image(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    else:
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+def shrink_image(path: str, prefix: str, limits: dict) -> str | None:
+    try:
+        source = Image.open(path)
+    except UnidentifiedImageError:
+        # Pillow may have no HEIC or AVIF decoder, such photos are sent as they are
+        return None
+    with source:
+        if getattr(source, "is_animated", False):
+            return None
+        has_metadata = any(key in source.info for key in ("exif", "xmp", "XML:com.adobe.xmp", "comment"))
+        if (os.path.getsize(path) <= limits["image_bytes"] and max(source.size) <= limits["image_side"]
+                and not has_metadata):
+            return None
+
+        has_alpha = source.mode in ("RGBA", "LA") or (source.mode == "P" and "transparency" in source.info)
+        # Orientation is applied to the pixels because EXIF doesn't survive re-encoding
+        image = ImageOps.exif_transpose(source)
+        image.thumbnail((limits["image_side"], limits["image_side"]), Image.Resampling.LANCZOS)
+
+    if has_alpha and source.format == "PNG":
+        data = encode_image(image, "PNG", 0)
+        if len(data) <= limits["image_bytes"]:
+            output = f"{prefix}.png"
+            write_variant(output, data)
+            return output
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    while True:
+        for quality in IMAGE_QUALITIES:
+            data = encode_image(image, "JPEG", quality)
+            if len(data) <= limits["image_bytes"]:
+                break
+        if len(data) <= limits["image_bytes"] or min(image.size) < 64:
+            break
+        image = image.resize((int(image.width * 0.75), int(image.height * 0.75)), Image.Resampling.LANCZOS)
+
+    output = f"{prefix}.jpg"
+    write_variant(output, data)
+    return output
+
+def transcode_video(path: str, prefix: str, limits: dict, info: dict) -> str | None:
+    too_large = max(info["width"] or 0, info["height"] or 0) > limits["video_side"]
+    too_long = info["duration"] is not None and info["duration"] > limits["video_duration"]
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None or (info["size"] <= limits["video_bytes"] and not too_large and not too_long):
+        return None
+
+    side = limits["video_side"]
+    output = f"{prefix}.mp4"
+    temp_path = get_temp_path(output)
+    if too_long:
+        print(f"{path} is longer than {limits['video_duration']}s, the variant is cut to that length")
+    subprocess.run([
+        ffmpeg, "-y", "-v", "error", "-i", path,
+        "-t", str(limits["video_duration"]),
+        "-map_metadata", "-1",
+        # Small videos keep their size, they are only transcoded for their length or bytes
+        "-vf", f"scale='min(iw,{side})':'min(ih,{side})':force_original_aspect_ratio=decrease:force_divisible_by=2",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-movflags", "+faststart",
+        temp_path,
+    ], check=True, capture_output=True)
+    size = os.path.getsize(temp_path)
+    if size > limits["video_bytes"]:
+        os.remove(temp_path)
+        raise ValueError(f"{os.path.basename(path)} is still {size} bytes after transcoding, "
+                         f"the limit is {limits['video_bytes']}")
+    os.replace(temp_path, output)
+    return output
+
+def preprocess_media(path: str, limits: dict, cache_dir: str) -> str:
+    # Runs in a worker process, variants are cached by content hash and the limits they were made for
+    limits_key = hashlib.sha256(json.dumps(limits, sort_keys=True).encode()).hexdigest()[:12]
+    prefix = os.path.join(cache_dir, f"{hash_file(path)}_{limits_key}")
+    for ext in (".orig", ".jpg", ".png", ".mp4"):
+        if os.path.isfile(prefix + ext):
+            os.utime(prefix + ext)
+            return path if ext == ".orig" else prefix + ext
+
+    info = probe_media(path)
+    mime = info["mime"]
+    output = None
+    if mime.startswith("image/"):
+        output = shrink_image(path, prefix, limits)
+    elif mime.startswith("video/"):
+        output = transcode_video(path, prefix, limits, info)
+
+    if output is None:
+        # Remember that the original already fits, so the file isn't decoded again
+        open(f"{prefix}.orig", "wb").close()
+        return path
+    return output
+
+class MediaProcessor:
+    def __init__(self, processes: int | None, cache_dir: str, cache_ttl: float):
+        self.processes = processes
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.pool: ProcessPoolExecutor | None = None
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Forking a process that already runs the network threads can copy their locks in a held state
+            self.pool = ProcessPoolExecutor(max_workers=self.processes,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return self.pool
+
+    async def run(self, path: str, network: str) -> str:
+        limits = get_media_limits(network)
+        if limits is None:
+            return path
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.get_pool(), preprocess_media, path, limits, self.cache_dir)
+        except Exception as e:
+            print(f"Error preprocessing {path} for {network}, sending the original: {e}")
+            return path
+
+    def remove_expired(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        expire_before = time.time() - self.cache_ttl
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
             try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"Error deleting file {file_path}: {e}")
+                if os.path.getmtime(path) < expire_before:
+                    os.remove(path)
+            except OSError as e:
+                print(f"Error deleting cached media {path}: {e}")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+media_processor = MediaProcessor(MEDIA_PROCESSES, MEDIA_CACHE_DIR, MEDIA_CACHE_TTL)
+
+class MediaStaging:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.download_lock = Lock()
+        self.prefetch_tasks: set[asyncio.Task] = set()
+        self.variants: dict[tuple[str, str], asyncio.Task] = {}
+        self.mapped: dict[str, MappedMedia] = {}
+        self.last_used = time.time()
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest_path = os.path.join(self.path, "manifest.json")
+        self.manifest: dict[str, dict] = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        numbers = [get_media_number(f) for f in os.listdir(self.path)]
+        self.counter = max((number for number in numbers if number is not None), default=0)
+
+    def keep_reserved(self, medias: list[dict]):
+        # A lazily downloaded media has no file yet, but a restored draft still holds its number
+        numbers = [get_media_number(os.path.basename(media["path"])) for media in medias]
+        self.counter = max([self.counter, *(number for number in numbers if number is not None)])
+
+    def reserve_path(self, ext: str) -> str:
+        self.counter += 1
+        self.last_used = time.time()
+        return os.path.join(self.path, f"media_{self.counter}{ext}")
+
+    def get_files(self) -> list[str]:
+        if not os.path.exists(self.path):
+            return []
+
+        files = [
+            (get_media_number(f), os.path.join(self.path, f))
+            for f in os.listdir(self.path)
+            if os.path.isfile(os.path.join(self.path, f)) and get_media_number(f) is not None
+        ]
+        return [path for _, path in sorted(files)]
+
+    async def get_hash(self, path: str) -> str:
+        info = self.describe(path)
+        if "sha256" not in info:
+            info["sha256"] = await asyncio.to_thread(hash_file, path)
+            self.save_manifest()
+        return info["sha256"]
+
+    def describe(self, path: str) -> dict:
+        # Every file is probed once per draft, publishers read the manifest instead of the file
+        info = self.manifest.get(path)
+        if info is None:
+            info = probe_media(path)
+            self.manifest[path] = info
+            self.save_manifest()
+        return info
+
+    def save_manifest(self):
+        temp_path = f"{self.manifest_path}.part"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f)
+        os.replace(temp_path, self.manifest_path)
+
+    async def download(self, medias: list[dict]) -> list[str]:
+        # Media is fetched from Telegram only once some network other than Telegram needs the bytes
+        async with self.download_lock:
+            missing = [media for media in medias if not os.path.isfile(media["path"])]
+            await asyncio.gather(*(download_telegram_file(media["file_id"], media["path"]) for media in missing))
+            for media in medias:
+                self.describe(media["path"])
+            self.last_used = time.time()
+        return [media["path"] for media in medias]
+
+    async def get_variant(self, path: str, network: str) -> str:
+        key = (path, network)
+        task = self.variants.get(key)
+        if task is None:
+            task = asyncio.create_task(media_processor.run(path, network))
+            self.variants[key] = task
+        # A publisher hitting its timeout must not cancel the variant other publishers are waiting for
+        return await asyncio.shield(task)
+
+    async def preprocess(self, medias: list[dict], network: str) -> list[str]:
+        paths = await self.download(medias)
+        variants = await asyncio.gather(*(self.get_variant(path, network) for path in paths))
+        for variant in variants:
+            self.describe(variant)
+        return list(variants)
+
+    async def prefetch(self, medias: list[dict], networks: list[str]):
+        try:
+            await asyncio.gather(*(self.preprocess(medias, network) for network in networks))
+        except Exception as e:
+            print(f"Error prefetching media into {self.path}: {e}")
+
+    def start_prefetch(self, medias: list[dict], networks: list[str]):
+        task = asyncio.create_task(self.prefetch(medias, networks))
+        self.prefetch_tasks.add(task)
+        task.add_done_callback(self.prefetch_tasks.discard)
+
+    def open_media(self, path: str) -> MappedMediaReader:
+        media = self.mapped.get(path)
+        if media is None:
+            media = MappedMedia(path)
+            self.mapped[path] = media
+        return media.open()
+
+    def close(self):
+        for media in self.mapped.values():
+            media.close()
+        self.mapped.clear()
+
+    async def cancel_tasks(self):
+        # A prefetch finishing after the files are removed would put old files and manifest entries back
+        tasks = [*self.prefetch_tasks, *self.variants.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def clear(self):
+        await self.cancel_tasks()
+        async with self.download_lock:
+            self.close()
+            self.variants.clear()
+            self.manifest.clear()
+            if os.path.isfile(self.manifest_path):
+                os.remove(self.manifest_path)
+            for file_path in self.get_files():
+                try:
+                    os.remove(file_path)
+                except Exception as e:
+                    print(f"Error deleting file {file_path}: {e}")
+            # The counter keeps going, so a slot of the old album is never handed out again
+            self.last_used = time.time()
+
+class MediaStagingRegistry:
+    def __init__(self, root: str, ttl: float):
+        self.root = root
+        self.ttl = ttl
+        self.stagings: dict[str, MediaStaging] = {}
+
+    def get_path(self, chat_id: int, user_id: int, draft_id: str) -> str:
+        return os.path.join(self.root, f"{chat_id}_{user_id}", draft_id)
+
+    def get(self, chat_id: int, user_id: int, draft_id: str) -> MediaStaging:
+        path = self.get_path(chat_id, user_id, draft_id)
+        staging = self.stagings.get(path)
+        if staging is None:
+            staging = MediaStaging(path)
+            self.stagings[path] = staging
+        return staging
+
+    async def discard(self, chat_id: int, user_id: int, draft_id: str):
+        path = self.get_path(chat_id, user_id, draft_id)
+        staging = self.stagings.pop(path, None)
+        if staging is not None:
+            await staging.cancel_tasks()
+            staging.close()
+        shutil.rmtree(path, ignore_errors=True)
+
+    def remove_expired(self, keep: set[str] = frozenset()):
+        if not os.path.isdir(self.root):
+            return
+
+        expire_before = time.time() - self.ttl
+        for owner in os.listdir(self.root):
+            owner_path = os.path.join(self.root, owner)
+            if not os.path.isdir(owner_path):
+                continue
+            for draft_id in os.listdir(owner_path):
+                path = os.path.join(owner_path, draft_id)
+                staging = self.stagings.get(path)
+                last_used = staging.last_used if staging else os.path.getmtime(path)
+                if last_used < expire_before and path not in keep:
+                    if staging is not None:
+                        self.stagings.pop(path).close()
+                    shutil.rmtree(path, ignore_errors=True)
+            if not os.listdir(owner_path):
+                os.rmdir(owner_path)
+
+media_stagings = MediaStagingRegistry(MEDIA_DIR, DRAFT_TTL)
+
+class AlbumCollector:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.albums: dict[tuple[int, str], list[Message]] = {}
+
+    async def collect(self, message: Message) -> list[Message] | None:
+        # Telegram delivers an album as separate messages, the first one waits for the rest
+        if not message.media_group_id:
+            return [message]
+
+        key = (message.chat.id, message.media_group_id)
+        album = self.albums.get(key)
+        if album is not None:
+            album.append(message)
+            return None
+
+        album = [message]
+        self.albums[key] = album
+        received = 0
+        while received != len(album):
+            received = len(album)
+            await asyncio.sleep(self.delay)
+        del self.albums[key]
+        return sorted(album, key=lambda m: m.message_id)
+
+album_collector = AlbumCollector(ALBUM_DELAY)
+
+def get_media_item(message: Message, staging: MediaStaging) -> dict | None:
+    if message.document:
+        filename = message.document.file_name
+        ext = os.path.splitext(filename)[1] or ""
+
+        media_type = "document"
+        file_id = message.document.file_id
+    elif message.photo:
+        filename = "media.jpg"
+        ext = os.path.splitext(filename)[1] or ""
+
+        media_type = "photo"
+        file_id = message.photo[-1].file_id
+    elif message.video:
+        filename = message.video.file_name or "media.mp4"
+        ext = os.path.splitext(filename)[1] or ""
+
+        media_type = "video"
+        file_id = message.video.file_id
+    else:
+        return None
+
+    return {
+        "file_id": file_id,
+        "type": media_type,
+        "path": staging.reserve_path(ext),
+    }
+
+def build_vk_post_script(group_id: int, message: str, caption: str, attachments: list[str | dict]) -> str:
+    # Attachments are either cached "photo{owner}_{id}" strings or upload server responses that still need saving
+    lines = ["var photos = [];", "var photo;", "var saved;", "var failed = 0;",
+             'var attachments = "";', 'var separator = "";']
+    for attachment in attachments:
+        if isinstance(attachment, str):
+            lines.append(f'attachments = attachments + separator + {json.dumps(attachment)}; separator = ",";')
+            continue
+        params = {
+            "group_id": group_id,
+            "photo": attachment["photo"],
+            "server": attachment["server"],
+            "hash": attachment["hash"],
+            "caption": caption,
+        }
+        lines.append(f"photo = API.photos.saveWallPhoto({json.dumps(params, ensure_ascii=False)})[0];")
+        lines.append('if (photo) { saved = "photo" + photo.owner_id + "_" + photo.id; photos.push(saved); '
+                     'attachments = attachments + separator + saved; separator = ","; } '
+                     'else { photos.push(""); failed = failed + 1; }')
+    # A post missing some of its photos is worse than no post, the saved ones are cached for the next attempt
+    lines.append('if (failed > 0) { return {"photos": photos, "failed": failed}; }')
+    lines.append(
+        f'var post = API.wall.post({{"owner_id": {-group_id}, "message": {json.dumps(message, ensure_ascii=False)}, '
+        f'"attachments": attachments, "from_group": 1}});'
+    )
+    lines.append('return {"photos": photos, "post_id": post.post_id};')
+    return "\n".join(lines)
+
+def post_media_file(session: "requests.Session", url: str, field: str, media: MappedMediaReader) -> "requests.Response":
+    response = session.post(url, files={field: (os.path.basename(media.name), media)})
+    # An upload server error is retried like any other, instead of the photo silently missing from the post
+    response.raise_for_status()
+    return response
 
 class CancellableScene(Scene,
                        reset_data_on_enter=False,
@@ -121,12 +1638,50 @@ class CancellableScene(Scene,
                        ):
     @on.callback_query(F.data == "back", after=After.back())
     async def handle_back(self, callback_query: CallbackQuery):
-        pass
+        # Going back restores the previous data from the scene history
+        self.wizard.data.pop("post_draft", None)
 
     @on.callback_query(F.data == "cancel")
     async def handle_cancel(self, callback_query: CallbackQuery):
         await self.wizard.goto(StartScene)
 
+    async def get_draft(self, reload: bool = False) -> PostDraft:
+        # The draft is read once per update and shared by every scene the update passes through
+        cached = self.wizard.data.get("post_draft")
+        if cached is None or reload:
+            draft = PostDraft.from_data(await self.wizard.get_data())
+            cached = (draft, draft.to_data())
+            self.wizard.data["post_draft"] = cached
+        return cached[0]
+
+    async def save_draft(self, draft: PostDraft):
+        data = draft.to_data()
+        cached = self.wizard.data.get("post_draft")
+        if cached is None or cached[1] != data:
+            await self.wizard.set_data(data)
+        self.wizard.data["post_draft"] = (draft, data)
+
+    async def edit_answer(self, draft: PostDraft, text: str, **kwargs):
+        # Only the ids of the control message are kept in the state, not the message itself
+        await message_editor.discard(draft.answer_chat_id, draft.answer_message_id)
+        await bot.edit_message_text(text=text, chat_id=draft.answer_chat_id,
+                                    message_id=draft.answer_message_id, **kwargs)
+
+    def get_staging(self, draft: PostDraft) -> MediaStaging:
+        key = self.wizard.state.key
+        staging = media_stagings.get(key.chat_id, key.user_id, draft.draft_id)
+        staging.keep_reserved(draft.media)
+        return staging
+
+    async def clear_media(self, draft: PostDraft):
+        await self.get_staging(draft).clear()
+        draft.media = []
+
+    async def discard_staging(self, draft: PostDraft):
+        key = self.wizard.state.key
+        if draft.draft_id:
+            await media_stagings.discard(key.chat_id, key.user_id, draft.draft_id)
+
 def extract_url_byte_positions(text: str, *, encoding: str = 'UTF-8') -> List[Tuple[str, int, int]]:
     encoded_text = text.encode(encoding)
 
@@ -142,315 +1697,1223 @@ def extract_url_byte_positions(text: str, *, encoding: str = 'UTF-8') -> List[Tu
 
     return url_byte_positions
 
-class SendScene(CancellableScene, state="SendScene"):
-    async def upload_to_tg(self, message: Message):
-        try:
-            data: FSMData = await self.wizard.get_data()
-            russian_text = data.get("russian_text")
-            profile_settings = data.get("profile_settings")
+class UploadCache:
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS uploaded_media (
+                    content_hash TEXT NOT NULL,
+                    network TEXT NOT NULL,
+                    profile TEXT NOT NULL,
+                    handle TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (content_hash, network, profile)
+                );
+                CREATE INDEX IF NOT EXISTS uploaded_media_last_used ON uploaded_media(last_used);
+                CREATE TABLE IF NOT EXISTS partial_uploads (
+                    content_hash TEXT NOT NULL,
+                    network TEXT NOT NULL,
+                    profile TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (content_hash, network, profile)
+                );
+            """)
+        return self.connection
+
+    def get(self, content_hash: str, network: Networks, profile: str) -> str | None:
+        connection = self.connect()
+        now = time.time()
+        key = (content_hash, network.name, profile)
+        with connection:
+            row = connection.execute(
+                "SELECT handle FROM uploaded_media WHERE content_hash = ? AND network = ? AND profile = ? AND expires_at > ?",
+                (*key, now)
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE uploaded_media SET last_used = ? WHERE content_hash = ? AND network = ? AND profile = ?",
+                    (now, *key)
+                )
+        return row[0] if row else None
+
+    def put(self, content_hash: str, network: Networks, profile: str, handle: str, ttl: float):
+        connection = self.connect()
+        now = time.time()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO uploaded_media (content_hash, network, profile, handle, expires_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, network.name, profile, handle, now + ttl, now)
+            )
+            connection.execute("DELETE FROM uploaded_media WHERE expires_at <= ?", (now,))
+            connection.execute(
+                "DELETE FROM uploaded_media WHERE rowid IN "
+                "(SELECT rowid FROM uploaded_media ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
 
-            media_group = MediaGroupBuilder(caption=russian_text)
-            medias = get_media_files()
+    def extend(self, content_hashes: list[str], network: Networks, profile: str, ttl: float):
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                "UPDATE uploaded_media SET expires_at = MAX(expires_at, ?) WHERE content_hash = ? AND network = ? AND profile = ?",
+                [(time.time() + ttl, content_hash, network.name, profile) for content_hash in content_hashes]
+            )
 
-            for media in medias:
-                mime, _ = mimetypes.guess_type(media)
-                file = FSInputFile(media)
+    def discard(self, content_hashes: list[str], network: Networks, profile: str):
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                "DELETE FROM uploaded_media WHERE content_hash = ? AND network = ? AND profile = ?",
+                [(content_hash, network.name, profile) for content_hash in content_hashes]
+            )
+
+    def get_partial(self, content_hash: str, network: Networks, profile: str) -> dict | None:
+        connection = self.connect()
+        with connection:
+            connection.execute("DELETE FROM partial_uploads WHERE expires_at <= ?", (time.time(),))
+            row = connection.execute(
+                "SELECT state FROM partial_uploads WHERE content_hash = ? AND network = ? AND profile = ?",
+                (content_hash, network.name, profile)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_partial(self, content_hash: str, network: Networks, profile: str, state: dict, expires_at: float):
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO partial_uploads (content_hash, network, profile, state, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (content_hash, network.name, profile, json.dumps(state), expires_at)
+            )
+
+    def discard_partial(self, content_hash: str, network: Networks, profile: str):
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "DELETE FROM partial_uploads WHERE content_hash = ? AND network = ? AND profile = ?",
+                (content_hash, network.name, profile)
+            )
+
+upload_cache = UploadCache(DATABASE, UPLOAD_CACHE_MAX_ENTRIES)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def get_delay(self, cost: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        # A request bigger than the bucket waits for a full bucket instead of forever
+        missing = min(cost, self.capacity) - self.tokens
+        return max(self.paused_until - now, missing / self.rate if missing > 0 else 0)
+
+    def take(self, cost: float):
+        self.tokens -= min(cost, self.capacity)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        return self.get_delay(self.capacity) == 0
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_PER_SECOND, TELEGRAM_GLOBAL_PER_SECOND)
+        self.chat_buckets: dict[int | str, TokenBucket] = {}
+        self.waiting = {self.INTERACTIVE: 0, self.BULK: 0}
+        self.installed = False
+
+    def install(self, bot: Bot):
+        bot.session.middleware(self)
+        self.installed = True
+
+    @staticmethod
+    def is_private(chat_id: int | str) -> bool:
+        # Groups and channels have negative ids or @usernames, only private chats are positive
+        return isinstance(chat_id, int) and chat_id > 0
+
+    def get_chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_idle()}
+            if self.is_private(chat_id):
+                bucket = TokenBucket(TELEGRAM_CHAT_PER_SECOND, TELEGRAM_CHAT_BURST)
+            else:
+                bucket = TokenBucket(TELEGRAM_GROUP_PER_MINUTE / 60, TELEGRAM_GROUP_PER_MINUTE)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id: int | str, cost: int, priority: int):
+        chat_bucket = self.get_chat_bucket(chat_id)
+        # A request still waiting for its own chat doesn't hold back requests to other chats
+        while (delay := chat_bucket.get_delay(cost)) > 0:
+            await asyncio.sleep(delay)
+        chat_bucket.take(cost)
+
+        self.waiting[priority] += 1
+        try:
+            while True:
+                delay = self.global_bucket.get_delay(cost)
+                # Edits in the admins' chats are served before posts to channels
+                ahead = any(self.waiting[other] for other in self.waiting if other < priority)
+                if delay == 0 and not ahead:
+                    self.global_bucket.take(cost)
+                    return
+                await asyncio.sleep(delay or 1 / TELEGRAM_GLOBAL_PER_SECOND)
+        finally:
+            self.waiting[priority] -= 1
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        # Only messages count towards the limits, but flood waits of every method are handled here
+        chat_id = getattr(method, "chat_id", None)
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        priority = self.INTERACTIVE if self.is_private(chat_id) else self.BULK
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                started = time.perf_counter()
+                await self.acquire(chat_id, cost, priority)
+                telegram_throttle_duration.observe(time.perf_counter() - started,
+                                                   priority="interactive" if priority == self.INTERACTIVE else "bulk")
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > TELEGRAM_RETRY_AFTER_ATTEMPTS or e.retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                    raise
+                retries.inc(network=Networks.Telegram.name, kind="rate_limit", error=type(e).__name__)
+                if chat_id is None:
+                    print(f"Telegram asked to wait {e.retry_after}s before {type(method).__name__}")
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    print(f"Telegram asked to wait {e.retry_after}s before {type(method).__name__} to {chat_id}")
+                    # Everything else queued for the chat waits out the flood control too
+                    self.get_chat_bucket(chat_id).pause(e.retry_after)
+
+telegram_rate_limiter = TelegramRateLimiter()
+
+class MessageEditor:
+    # Edits of a message within the debounce interval are merged, only the latest text is sent
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        self.pending: dict[tuple[int, int], dict] = {}
+        self.workers: dict[tuple[int, int], tuple[asyncio.Task, asyncio.Event]] = {}
+
+    def edit(self, chat_id: int, message_id: int, text: str, **kwargs):
+        key = (chat_id, message_id)
+        self.pending[key] = {"text": text, **kwargs}
+        if key not in self.workers:
+            wake = asyncio.Event()
+            self.workers[key] = (asyncio.create_task(self.run(key, wake)), wake)
+
+    async def run(self, key: tuple[int, int], wake: asyncio.Event):
+        # One worker per message keeps its edits in order
+        try:
+            while key in self.pending:
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout=self.debounce)
+                except asyncio.TimeoutError:
+                    pass
+                # A flush wakes the worker once, later edits are debounced again
+                wake.clear()
+                edit = self.pending.pop(key, None)
+                if edit is not None:
+                    await self.send(key, edit)
+        finally:
+            self.workers.pop(key, None)
+
+    async def send(self, key: tuple[int, int], edit: dict) -> bool:
+        chat_id, message_id = key
+        try:
+            await RetryPolicy.for_network(Networks.Telegram).call(RetryStats(), bot.edit_message_text,
+                                                                  chat_id=chat_id, message_id=message_id, **edit)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return True
+            print(f"Error editing message {message_id} in {chat_id}: {e}")
+            return False
+        except Exception as e:
+            print(f"Error editing message {message_id} in {chat_id}: {e}")
+            return False
+        return True
+
+    async def flush(self, chat_id: int, message_id: int):
+        worker = self.workers.get((chat_id, message_id))
+        if worker is not None:
+            task, wake = worker
+            wake.set()
+            await asyncio.shield(task)
+
+    async def discard(self, chat_id: int, message_id: int):
+        # A newer edit made elsewhere must not be overwritten by a pending one
+        self.pending.pop((chat_id, message_id), None)
+        await self.flush(chat_id, message_id)
+
+message_editor = MessageEditor(STATUS_DEBOUNCE)
+
+class PublishProgress:
+    def __init__(self, chat_id: int, message_id: int, networks: list[str],
+                 results: dict[str, tuple[bool, str]] | None = None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.networks = [network for network in SOCIAL_NETWORKS if network in networks]
+        self.states = {network: f"⏳ {network}: queued" for network in self.networks}
+        self.finished_networks: dict[str, bool] = {}
+        self.running = False
+        for network, (ok, text) in (results or {}).items():
+            self.set_finished(network, ok, text)
+
+    def render(self) -> str:
+        if not self.running and not self.finished_networks:
+            header = "⏳ Post queued for publishing"
+        elif len(self.finished_networks) < len(self.networks):
+            header = "⏳ Publishing post"
+        elif all(self.finished_networks.values()):
+            header = "✅ Post published"
+        else:
+            header = "⚠️ Post published with errors"
+        return "\n\n".join([header, *(self.states[network] for network in self.networks)])
+
+    def show(self):
+        message_editor.edit(self.chat_id, self.message_id, self.render())
+
+    def set_finished(self, network: str, ok: bool, text: str):
+        self.states[network] = text
+        self.finished_networks[network] = ok
+
+    def started(self, network: str):
+        self.running = True
+        self.states[network] = f"🔄 {network}: publishing"
+        self.show()
+
+    def uploading(self, network: str, done: int, total: int):
+        self.states[network] = f"⬆️ {network}: uploading {done}/{total}"
+        self.show()
+
+    def finished(self, network: str, ok: bool, text: str):
+        self.set_finished(network, ok, text)
+        self.show()
+
+    async def close(self):
+        # The results must reach the user, they get a new message if the status can't be edited
+        await message_editor.discard(self.chat_id, self.message_id)
+        text = self.render()
+        if await message_editor.send((self.chat_id, self.message_id), {"text": text}):
+            return
+        try:
+            await bot.send_message(chat_id=self.chat_id, text=text)
+        except Exception as e:
+            print(f"Error sending publish results to {self.chat_id}: {e}")
+
+class PostPublisher:
+    def __init__(self, post: dict, progress: PublishProgress | None = None):
+        self.post = post
+        self.progress = progress
+        self.uploads: dict[Networks, list[int]] = {}
+        self.profile_settings = config["profiles"][post["profile"]]
+        self.clients = client_registry.get(post["profile"])
+        self.staging = media_stagings.get(post["chat_id"], post["user_id"], post["draft_id"])
+        self.retry_stats = {network: RetryStats() for network in Networks}
+
+    async def call(self, network: Networks, func, *args, idempotent: bool = True, **kwargs):
+        if asyncio.iscoroutinefunction(func):
+            step = func
+        else:
+            step = partial(network_executor.run, network, func)
+        return await RetryPolicy.for_network(network).call(self.retry_stats[network], step, *args,
+                                                           idempotent=idempotent, **kwargs)
+
+    async def get_media_paths(self, network: Networks) -> list[str]:
+        return await self.staging.preprocess(self.post["media"], network.name)
+
+    def start_uploads(self, network: Networks, total: int):
+        self.uploads[network] = [0, total]
+        self.report_uploads(network)
+
+    def finish_upload(self, network: Networks):
+        if network in self.uploads:
+            self.uploads[network][0] += 1
+            self.report_uploads(network)
+
+    def report_uploads(self, network: Networks):
+        done, total = self.uploads[network]
+        if self.progress is not None and total:
+            self.progress.uploading(network.name, done, total)
+
+    def count_upload(self, network: Networks, size: int):
+        uploaded_bytes.inc(size, network=network.name, profile=self.post["profile"])
+
+    async def upload_once(self, network: Networks, file: str, upload) -> tuple[str, str]:
+        # The same bytes are uploaded once per network and profile while the remote handle is alive
+        content_hash = await self.staging.get_hash(file)
+        if UPLOAD_CACHE_ENABLED:
+            handle = upload_cache.get(content_hash, network, self.post["profile"])
+            if handle is not None:
+                self.finish_upload(network)
+                return content_hash, handle
+
+        handle, ttl = await upload()
+        if UPLOAD_CACHE_ENABLED and ttl > 0:
+            upload_cache.put(content_hash, network, self.post["profile"], handle, ttl)
+        self.finish_upload(network)
+        return content_hash, handle
+
+    async def create_post(self, network: Networks, content_hashes: list[str], func, *args, **kwargs):
+        try:
+            return await self.call(network, func, *args, idempotent=False, **kwargs)
+        except Exception as e:
+            self.forget_uploads(network, content_hashes, e)
+            raise
+
+    def forget_uploads(self, network: Networks, content_hashes: list[str], error: Exception):
+        # A rejected post may be caused by a cached handle that's no longer valid
+        if content_hashes and classify_error(error)[0] == "permanent":
+            upload_cache.discard(content_hashes, network, self.post["profile"])
+
+    async def upload_to_tg(self):
+        russian_text = self.post["russian_text"]
+
+        media_group = MediaGroupBuilder(caption=russian_text)
+        medias = self.post["media"]
+        upload_size = 0
+
+        for media in medias:
+            if media["type"] == "photo":
+                media_group.add_photo(media=media["file_id"])
+            elif media["type"] == "video":
+                media_group.add_video(media=media["file_id"])
+            else:
+                # Documents can't be resent as photos or videos by file_id
+                path, = await self.staging.download([media])
+                mime = self.staging.describe(path)["mime"]
+                file = FSInputFile(path)
+                upload_size += self.staging.describe(path)["size"]
 
                 if mime.startswith("image/"):
                     media_group.add_photo(media=file)
                 elif mime.startswith("video/"):
                     media_group.add_video(media=file)
 
-            if len(medias) > 0:
-                await bot.send_media_group(chat_id=profile_settings["TG_CHANNEL_ID"], media=media_group.build())
-            else:
-                await bot.send_message(chat_id=profile_settings["TG_CHANNEL_ID"], text=russian_text)
-
-            await bot.send_message(chat_id=message.chat.id,
-                text="✅ Created TG post"
-            )
-        except Exception as e:
-            await bot.send_message(chat_id=message.chat.id,
-                text=f"❌ Failed to create TG post\n{str(e)}"
-            )
-
-    async def upload_to_vk(self, message: Message):
-        try:
-            data: FSMData = await self.wizard.get_data()
-            profile_settings = data.get("profile_settings")
-            russian_text = data.get("russian_text")
-            tags = data.get("tags")
-
-            vk_session = vk_api.VkApi(
-                token=profile_settings["VK_TOKEN"])
-            vk = vk_session.get_api()
-            uploadServer = vk.photos.getWallUploadServer(
+        if len(medias) > 0:
+            await self.call(Networks.Telegram, bot.send_media_group,
+                            chat_id=self.profile_settings["TG_CHANNEL_ID"], media=media_group.build(),
+                            idempotent=False)
+            self.count_upload(Networks.Telegram, upload_size)
+        else:
+            await self.call(Networks.Telegram, bot.send_message,
+                            chat_id=self.profile_settings["TG_CHANNEL_ID"], text=russian_text,
+                            idempotent=False)
+
+        return "✅ Created TG post"
+
+    async def upload_to_vk(self):
+        profile_settings = self.profile_settings
+        russian_text = self.post["russian_text"]
+        tags = self.post["tags"]
+
+        profile = self.post["profile"]
+        vk_session = self.clients.get_vk()
+        vk = vk_session.get_api()
+
+        files = await self.get_media_paths(Networks.VK)
+        content_hashes = [await self.staging.get_hash(file) for file in files]
+        cached = [
+            upload_cache.get(content_hash, Networks.VK, profile) if UPLOAD_CACHE_ENABLED else None
+            for content_hash in content_hashes
+        ]
+        missing = [file for file, attachment in zip(files, cached) if attachment is None]
+
+        async def upload_photo(upload_url: str, file: str):
+            response = await self.call(Networks.VK, post_media_file, vk_session.http, upload_url, "photo",
+                                       self.staging.open_media(file))
+            self.finish_upload(Networks.VK)
+            return response
+
+        uploads = {}
+        if missing:
+            self.start_uploads(Networks.VK, len(missing))
+            upload_server = await self.call(Networks.VK, vk.photos.getWallUploadServer,
                 group_id=profile_settings["VK_GROUP_ID"]
             )
-
-            files = get_media_files()
-            attachments = []
-            for file in files:
-                with open(file, "rb") as temp:
-                    photo_files = {"photo": temp}
-                    upload_response = requests.post(uploadServer["upload_url"], files=photo_files)
-                    if upload_response and upload_response.status_code == 200:
-                        json_response = upload_response.json()
-
-                        photos_response = vk.photos.saveWallPhoto(
-                            photo=json_response["photo"],
-                            server=json_response["server"],
-                            hash=json_response["hash"],
-                            group_id=profile_settings["VK_GROUP_ID"],
-                            caption=tags
-                        )
-
-                        attachments.append(f"photo{photos_response[0]['owner_id']}_{photos_response[0]['id']}")
-
-            post_response = vk.wall.post(
-                owner_id=-1 * profile_settings["VK_GROUP_ID"],
-                message=russian_text,
-                attachments=attachments,
-                from_group=1
-            )
-            if post_response['post_id']:
-                await bot.send_message(chat_id=message.chat.id,
-                    text=f"✅ Created VK post: https://vk.com/wall-{profile_settings["VK_GROUP_ID"]}_{post_response['post_id']}"
-                )
+            # The photos travel in parallel over the session's connection pool
+            upload_responses = await asyncio.gather(*(
+                upload_photo(upload_server["upload_url"], file) for file in missing
+            ))
+            uploads = {file: upload_response.json() for file, upload_response in zip(missing, upload_responses)}
+            self.count_upload(Networks.VK, sum(self.staging.describe(file)["size"] for file in uploads))
+
+        attachments = []
+        saved_hashes = {}
+        for file, content_hash, attachment in zip(files, content_hashes, cached):
+            if attachment is not None:
+                attachments.append(attachment)
+            else:
+                saved_hashes[len(attachments)] = content_hash
+                attachments.append(uploads[file])
+        cached_hashes = [content_hash for content_hash, attachment in zip(content_hashes, cached) if attachment]
+
+        async def execute_post() -> dict:
+            # Saving every photo and creating the post is a single execute request instead of one call per photo
+            unsaved = [index for index, attachment in enumerate(attachments) if isinstance(attachment, dict)]
+            code = build_vk_post_script(profile_settings["VK_GROUP_ID"], russian_text, tags, attachments)
+            response = await network_executor.run(Networks.VK, vk_session.method, "execute", {"code": code},
+                                                  raw=True)
+            post_response = response.get("response") or {}
+            for index, attachment in zip(unsaved, post_response.get("photos") or []):
+                if attachment:
+                    # A retry posts the photos saved by this attempt instead of saving them again
+                    attachments[index] = attachment
+                    if UPLOAD_CACHE_ENABLED:
+                        upload_cache.put(saved_hashes[index], Networks.VK, profile, attachment, UPLOAD_CACHE_TTL)
+            errors = response.get("execute_errors")
+            if not post_response.get("post_id") and not post_response.get("failed") and errors:
+                # Raised inside the retried step, so a flood control error from wall.post is retried
+                raise vk_api.ApiError(vk_session, "execute", {"code": code}, True, errors[0])
+            return response
+
+        response = await self.create_post(Networks.VK, cached_hashes, execute_post)
+        post_response = response.get("response") or {}
+        if post_response.get("failed"):
+            errors = response.get("execute_errors")
+            error = errors[0].get("error_msg") if errors else "unknown error"
+            raise ValueError(f"VK couldn't save {post_response['failed']} of {len(saved_hashes)} photos: {error}")
+        if post_response.get('post_id'):
+            return f"✅ Created VK post: https://vk.com/wall-{profile_settings["VK_GROUP_ID"]}_{post_response['post_id']}"
+
+    async def upload_to_twitter(self):
+        english_text = self.post["english_text"]
+        tags = self.post["tags"]
+        twitter_reply_post = self.post["twitter_reply_post"]
+
+        twitter_api, client = self.clients.get_twitter()
+        upload_slots = asyncio.Semaphore(TWITTER_UPLOAD_CONCURRENCY)
+
+        async def upload_media(file: str) -> tuple[str, float]:
+            mime = self.staging.describe(file)["mime"]
+            async with upload_slots:
+                if mime.startswith("video/") or mime == "image/gif":
+                    media = await self.upload_chunked_to_twitter(twitter_api, file, mime)
+                else:
+                    media = await self.call(Networks.Twitter, twitter_api.simple_upload,
+                                            filename=file, file=self.staging.open_media(file))
+                    self.count_upload(Networks.Twitter, self.staging.describe(file)["size"])
+            # Uploaded media can only be attached until it expires, usually a day later
+            expires_after = getattr(media, "expires_after_secs", 86400)
+            return str(media.media_id), expires_after - UPLOAD_CACHE_TWITTER_MARGIN
+
+        files = await self.get_media_paths(Networks.Twitter)
+        self.start_uploads(Networks.Twitter, len(files))
+        uploads = await asyncio.gather(*(
+            self.upload_once(Networks.Twitter, file, partial(upload_media, file)) for file in files
+        ))
+        content_hashes = [content_hash for content_hash, _ in uploads]
+        media_ids = [media_id for _, media_id in uploads]
+
+        text = english_text
+        if tags != "":
+            text += "\n\n" + tags
+
+        reply_id = None
+        if twitter_reply_post:
+            reply_id = twitter_reply_post.split("/")[-1]
+
+        if len(media_ids) > 0:
+            tweet_post = await self.create_post(Networks.Twitter, content_hashes, client.create_tweet,
+                                                text=text, media_ids=media_ids, in_reply_to_tweet_id=reply_id)
+        else:
+            tweet_post = await self.call(Networks.Twitter, client.create_tweet, idempotent=False,
+                                                    text=text, in_reply_to_tweet_id=reply_id)
+        if tweet_post:
+            twitter_username = await self.clients.get_twitter_username()
+            return f"✅ Created Twitter post: https://x.com/{twitter_username}/status/{tweet_post.data['id']}"
+
+    async def upload_chunked_to_twitter(self, twitter_api: "tweepy.API", file: str, mime: str):
+        profile = self.post["profile"]
+        content_hash = await self.staging.get_hash(file)
+        size = self.staging.describe(file)["size"]
+        chunk_size = max(min(TWITTER_CHUNK_SIZE, TWITTER_MAX_CHUNK_SIZE), -(-size // TWITTER_MAX_SEGMENTS))
+        segments = -(-size // chunk_size)
+
+        # Segments acknowledged before a dropped connection or a restart aren't sent again
+        state = upload_cache.get_partial(content_hash, Networks.Twitter, profile)
+        if state is None or state["chunk_size"] != chunk_size:
+            media = await self.call(Networks.Twitter, twitter_api.chunked_upload_init, size, mime,
+                                    media_category="tweet_gif" if mime == "image/gif" else "tweet_video")
+            state = {"media_id": media.media_id, "chunk_size": chunk_size, "next_segment": 0,
+                     "expires_at": time.time() + getattr(media, "expires_after_secs", 86400)}
+
+        reader = self.staging.open_media(file)
+        try:
+            for segment in range(state["next_segment"], segments):
+                reader.seek(segment * chunk_size)
+                chunk = reader.read(chunk_size)
+                await self.call(Networks.Twitter, twitter_api.chunked_upload_append, state["media_id"],
+                                (os.path.basename(file), chunk), segment)
+                self.count_upload(Networks.Twitter, len(chunk))
+                state["next_segment"] = segment + 1
+                upload_cache.save_partial(content_hash, Networks.Twitter, profile, state, state["expires_at"])
+            media = await self.call(Networks.Twitter, twitter_api.chunked_upload_finalize, state["media_id"])
         except Exception as e:
-            await bot.send_message(chat_id=message.chat.id,
-                text=f"❌ Failed to create VK post\n{str(e)}"
+            if classify_error(e)[0] == "permanent":
+                upload_cache.discard_partial(content_hash, Networks.Twitter, profile)
+            raise
+        upload_cache.discard_partial(content_hash, Networks.Twitter, profile)
+
+        processing_info = getattr(media, "processing_info", None)
+        while processing_info and processing_info["state"] in ("pending", "in_progress"):
+            await asyncio.sleep(processing_info.get("check_after_secs", 1))
+            media = await self.call(Networks.Twitter, twitter_api.get_media_upload_status, state["media_id"])
+            processing_info = getattr(media, "processing_info", None)
+        if processing_info and processing_info["state"] == "failed":
+            error = processing_info.get("error") or {}
+            raise ValueError(f"Twitter couldn't process {os.path.basename(file)}: {error.get('message', 'unknown error')}")
+        return media
+
+    async def upload_to_tumblr(self):
+        def format_links(text: str) -> str:
+            url_pattern = r"https?://[^\s\]\)]+"
+            return re.sub(url_pattern, lambda m: f"[{m.group(0)}]({m.group(0)})", text)
+
+        english_text = self.post["english_text"]
+        clean_tags = self.post["clean_tags"]
+
+        tumblr_api = self.clients.get_tumblr()
+        tumblr_user = await self.clients.get_tumblr_blog_name()
+
+        tumblr_response = None
+        files = await self.get_media_paths(Networks.Tumblr)
+        if len(files) > 0:
+            # Tumblr takes every file in the request that creates the post
+            self.start_uploads(Networks.Tumblr, len(files))
+            mime = self.staging.describe(files[-1])["mime"]
+            if mime.startswith("image/"):
+                tumblr_response = await self.call(Networks.Tumblr, call_tumblr, tumblr_api.create_photo,
+                                                          tumblr_user, tags=clean_tags, idempotent=False,
+                                                          caption=format_links(english_text),
+                                                          format="markdown",
+                                                          data=files)
+            elif mime.startswith("video/"):
+                tumblr_response = await self.call(Networks.Tumblr, call_tumblr, tumblr_api.create_video,
+                                                          tumblr_user, tags=clean_tags, idempotent=False,
+                                                          caption=format_links(english_text),
+                                                          format="markdown",
+                                                          data=files)
+            if tumblr_response:
+                self.count_upload(Networks.Tumblr, sum(self.staging.describe(file)["size"] for file in files))
+        else:
+            tumblr_response = await self.call(Networks.Tumblr, call_tumblr, tumblr_api.create_text,
+                                                         tumblr_user, tags=clean_tags, idempotent=False,
+                                                         body=format_links(english_text))
+        if tumblr_response and tumblr_response['id']:
+            tumblr_url = f"https://tumblr.com/{tumblr_user}/{tumblr_response['id']}"
+            return f"✅ Created Tumblr post: {tumblr_url}"
+
+    async def upload_to_bsky(self):
+        english_text = self.post["english_text"]
+        bsky_tags = self.post["bsky_tags"]
+        bsky_reply_post = self.post["bsky_reply_post"]
+
+        embeds = []
+
+        bluesky_api = await self.clients.get_bluesky()
+
+        async def upload_blob(file: str) -> tuple[str, float]:
+            # httpx streams file-like bodies in chunks instead of holding the whole video in memory
+            blob = (await self.call(Networks.Bluesky, bluesky_api.upload_blob, self.staging.open_media(file))).blob
+            self.count_upload(Networks.Bluesky, self.staging.describe(file)["size"])
+            # Blobs no post refers to are garbage collected by the PDS, the TTL is extended once posted
+            return json.dumps(blob.model_dump(by_alias=True, mode="json")), UPLOAD_CACHE_PENDING_BLOB_TTL
+
+        files = await self.get_media_paths(Networks.Bluesky)
+        self.start_uploads(Networks.Bluesky, len(files))
+        content_hashes = []
+        is_video = False
+        for file in files:
+            info = self.staging.describe(file)
+            mime = info["mime"]
+            aspect_ratio = None
+            if info["width"] and info["height"]:
+                aspect_ratio = models.AppBskyEmbedDefs.AspectRatio(width=info["width"], height=info["height"])
+            content_hash, blob = await self.upload_once(Networks.Bluesky, file, partial(upload_blob, file))
+            content_hashes.append(content_hash)
+            uploaded_blob = models.blob_ref.BlobRef.model_validate(json.loads(blob))
+
+            if mime.startswith("image/"):
+                embeds.append(models.AppBskyEmbedImages.Image(
+                                image=uploaded_blob,
+                                alt="",
+                                aspect_ratio=aspect_ratio,
+                ))
+            elif mime.startswith("video/"):
+                embeds.append(models.AppBskyEmbedVideo.Main(
+                    video=uploaded_blob,
+                    alt="",
+                    aspect_ratio=aspect_ratio,
+                ))
+                is_video = True
+
+        facets = []
+        for hashtag in bsky_tags:
+            facets.append(models.AppBskyRichtextFacet.Main(
+                features=[models.AppBskyRichtextFacet.Tag(tag=hashtag)],
+                index=models.AppBskyRichtextFacet.ByteSlice(byte_start=len(english_text),
+                                                            byte_end=len(english_text)))
             )
 
-    async def upload_to_twitter(self, message: Message):
-        try:
-            media_ids = []
-
-            data: FSMData = await self.wizard.get_data()
-            profile_settings = data.get("profile_settings")
-            english_text = data.get("english_text")
-            tags = data.get("tags")
-            twitter_reply_post = data.get("twitter_reply_post")
-
-            twitter_auth = tweepy.OAuth1UserHandler(
-                profile_settings["TWITTER_CONSUMER_KEY"],
-                profile_settings["TWITTER_CONSUMER_SECRET"],
-                profile_settings["TWITTER_ACCESS_TOKEN"],
-                profile_settings["TWITTER_ACCESS_SECRET"]
+        url_positions = extract_url_byte_positions(english_text)
+        for link_data in url_positions:
+            uri, byte_start, byte_end = link_data
+            facets.append(
+                models.AppBskyRichtextFacet.Main(
+                    features=[models.AppBskyRichtextFacet.Link(uri=uri)],
+                    index=models.AppBskyRichtextFacet.ByteSlice(byte_start=byte_start, byte_end=byte_end),
+                )
             )
 
-            twitter_api = tweepy.API(twitter_auth)
-
-            client = tweepy.Client(consumer_key=profile_settings["TWITTER_CONSUMER_KEY"],
-                                   consumer_secret=profile_settings["TWITTER_CONSUMER_SECRET"],
-                                   access_token=profile_settings["TWITTER_ACCESS_TOKEN"],
-                                   access_token_secret=profile_settings["TWITTER_ACCESS_SECRET"])
+        reply_ref = None
+        if bsky_reply_post:
+            url_parts = bsky_reply_post.split('/')
+            handle = url_parts[4]
+            post_rkey = url_parts[6]
 
-            files = get_media_files()
-            for file in files:
-                media = twitter_api.media_upload(filename=file)
-                media_ids.append(media.media_id)
+            did = await resolve_bluesky_handle(handle)
+            if not did:
+                raise ValueError(f'Could not resolve DID for handle "{handle}".')
 
-            text = english_text
-            if tags != "":
-                text += "\n\n" + tags
+            response = await self.call(Networks.Bluesky, bluesky_api.get_post, post_rkey, did)
 
-            reply_id = None
-            if twitter_reply_post:
-                reply_id = twitter_reply_post.split("/")[-1]
-
-            if len(media_ids) > 0:
-                tweet_post = client.create_tweet(text=text, media_ids=media_ids, in_reply_to_tweet_id=reply_id)
-            else:
-                tweet_post = client.create_tweet(text=text, in_reply_to_tweet_id=reply_id)
-            if tweet_post:
-                my_twitter = client.get_me(user_auth=True)
-                await bot.send_message(chat_id=message.chat.id,
-                    text=f"✅ Created Twitter post: https://x.com/{my_twitter.data['username']}/status/{tweet_post.data['id']}"
-                )
+            record_ref = models.ComAtprotoRepoStrongRef.Main(
+                cid=response.cid,
+                uri=response.uri
+            )
+            reply_ref = models.AppBskyFeedPost.ReplyRef(
+                parent=record_ref, root=record_ref
+            )
+        if not is_video:
+            bluesky_response = await self.create_post(Networks.Bluesky, content_hashes, bluesky_api.send_post,
+                                                     text=english_text, langs=["en-US"],
+                                                     embed=models.AppBskyEmbedImages.Main(
+                                                         images=embeds
+                                                     ),
+                                                     reply_to=reply_ref,
+                                                     facets=facets
+            )
+        else:
+            bluesky_response = await self.create_post(Networks.Bluesky, content_hashes, bluesky_api.send_post,
+                                                     text=english_text, langs=["en-US"],
+                                                     embed=embeds[0],
+                                                     facets=facets
+            )
+        if UPLOAD_CACHE_ENABLED and content_hashes:
+            upload_cache.extend(content_hashes, Networks.Bluesky, self.post["profile"], UPLOAD_CACHE_TTL)
+        if bluesky_response and bluesky_response["uri"]:
+            at_uri = bluesky_response["uri"]
+            parts = at_uri[5:].split("/")
+            if len(parts) == 3:
+                did, collection, rkey = parts
+
+                if collection == "app.bsky.feed.post":
+                    bluesky_url = f"https://bsky.app/profile/{did}/post/{rkey}"
+                    return f"✅ Created Bluesky post: {bluesky_url}"
+
+    async def publish_to_network(self, network: str, upload) -> tuple[bool, str]:
+        started = time.perf_counter()
+        ok, text = await self.run_upload(network, upload)
+        publish_duration.observe(time.perf_counter() - started, network=network, profile=self.post["profile"],
+                                 result="ok" if ok else "failed")
+        stats = self.retry_stats[Networks[network]]
+        if stats.retries:
+            text += f"\n↻ {stats}"
+        return ok, text
+
+    async def run_upload(self, network: str, upload) -> tuple[bool, str]:
+        profile = self.post["profile"]
+        try:
+            result = await asyncio.wait_for(upload(), timeout=NETWORK_TIMEOUT)
+        except asyncio.TimeoutError:
+            publish_failures.inc(network=network, profile=profile, kind="timeout", error="TimeoutError")
+            return False, f"❌ {network} post timed out after {NETWORK_TIMEOUT}s"
         except Exception as e:
-            await bot.send_message(chat_id=message.chat.id,
-                text=f"❌ Failed to create Twitter post\n{str(e)}",
+            publish_failures.inc(network=network, profile=profile, kind=classify_error(e)[0], error=type(e).__name__)
+            return False, f"❌ Failed to create {network} post\n{str(e)}"
+        if not result:
+            publish_failures.inc(network=network, profile=profile, kind="empty", error="")
+            return False, f"❌ {network} post was not created"
+        return True, result
+
+    async def publish(self, networks: list[str], on_result=None, on_start=None) -> list[str]:
+        selected = [network for network in SOCIAL_NETWORKS if network in networks]
+        deadline_exceeded = f"publish deadline of {PUBLISH_DEADLINE}s exceeded"
+
+        async def run(network: str) -> str:
+            if on_start:
+                on_start(network)
+            if self.progress is not None:
+                self.progress.started(network)
+            upload = getattr(self, NETWORK_PUBLISHERS[Networks[network]].upload)
+            ok, text = await self.publish_to_network(network, upload)
+            if on_result:
+                await on_result(network, ok, text)
+            return text
+
+        if not PUBLISH_CONCURRENTLY:
+            results = []
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + PUBLISH_DEADLINE
+            for network in selected:
+                if loop.time() >= deadline:
+                    text = f"❌ {network} post was skipped: {deadline_exceeded}"
+                    if on_result:
+                        await on_result(network, False, text)
+                    results.append(text)
+                    continue
+                results.append(await run(network))
+            return results
+
+        tasks = [asyncio.create_task(run(network)) for network in selected]
+        if not tasks:
+            return []
+
+        _, pending = await asyncio.wait(tasks, timeout=PUBLISH_DEADLINE)
+        for task in pending:
+            task.cancel()
+        # Wait for cancelled branches too, media must stay on disk until every upload has let go of it
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        results = []
+        for network, task in zip(selected, tasks):
+            if task.cancelled():
+                text = f"❌ {network} post was cancelled: {deadline_exceeded}"
+                if on_result:
+                    await on_result(network, False, text)
+                results.append(text)
+            else:
+                results.append(task.result())
+        return results
+
+class PublishQueue:
+    def __init__(self, path: str, workers: int, handler, failure_handler, drain_timeout: float):
+        self.path = path
+        self.workers = workers
+        self.handler = handler
+        self.failure_handler = failure_handler
+        self.drain_timeout = drain_timeout
+        self.connection = None
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.tasks: list[asyncio.Task] = []
+        self.running: set[int] = set()
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS publish_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    status TEXT NOT NULL,
+                    post TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS publish_network_jobs (
+                    job_id INTEGER NOT NULL REFERENCES publish_jobs(id),
+                    network TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (job_id, network)
+                );
+                CREATE INDEX IF NOT EXISTS publish_jobs_status ON publish_jobs(status, id);
+            """)
+        return self.connection
+
+    def enqueue(self, post: dict) -> int:
+        connection = self.connect()
+        with connection:
+            return self.add_job(connection, post)
+
+    def add_job(self, connection: sqlite3.Connection, post: dict) -> int:
+        # Runs in the caller's transaction, the scheduler commits a job together with its scheduled post
+        now = time.time()
+        cursor = connection.execute(
+            "INSERT INTO publish_jobs (status, post, created_at, updated_at) VALUES ('pending', ?, ?, ?)",
+            (json.dumps(post), now, now)
+        )
+        job_id = cursor.lastrowid
+        connection.executemany(
+            "INSERT INTO publish_network_jobs (job_id, network, status, updated_at) VALUES (?, ?, 'pending', ?)",
+            [(job_id, network, now) for network in post["networks"]]
+        )
+        # Workers only run once the caller yields to the event loop, after the transaction is committed
+        self.wakeup.set()
+        return job_id
+
+    def claim(self) -> tuple[int, dict, list[str]] | None:
+        connection = self.connect()
+        with connection:
+            row = connection.execute(
+                "SELECT id, post FROM publish_jobs WHERE status = 'pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE publish_jobs SET status = 'running', updated_at = ? WHERE id = ?", (time.time(), row["id"])
+            )
+            networks = [network_row["network"] for network_row in connection.execute(
+                "SELECT network FROM publish_network_jobs WHERE job_id = ? AND status IN ('pending', 'running')",
+                (row["id"],)
+            )]
+        return row["id"], json.loads(row["post"]), networks
+
+    def set_network_state(self, job_id: int, network: str, status: str, result: str | None = None):
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "UPDATE publish_network_jobs SET status = ?, result = ?, updated_at = ? WHERE job_id = ? AND network = ?",
+                (status, result, time.time(), job_id, network)
             )
 
-    async def upload_to_tumblr(self, message: Message):
-        try:
-            def format_links(text: str) -> str:
-                url_pattern = r"https?://[^\s\]\)]+"
-                return re.sub(url_pattern, lambda m: f"[{m.group(0)}]({m.group(0)})", text)
-
-            data: FSMData = await self.wizard.get_data()
-            profile_settings = data.get("profile_settings")
-            english_text = data.get("english_text")
-            clean_tags = data.get("clean_tags")
-
-            tumblr_api = pytumblr.TumblrRestClient(
-                profile_settings["TUMBLR_CONSUMER_KEY"],
-                profile_settings["TUMBLR_CONSUMER_SECRET"],
-                profile_settings["TUMBLR_ACCESS_TOKEN"],
-                profile_settings["TUMBLR_ACCESS_SECRET"]
+    def get_results(self, job_id: int) -> list[str]:
+        rows = self.connect().execute(
+            "SELECT network, result FROM publish_network_jobs WHERE job_id = ?", (job_id,)
+        ).fetchall()
+        results = {row["network"]: row["result"] for row in rows if row["result"]}
+        return [results[network] for network in SOCIAL_NETWORKS if network in results]
+
+    def count_by_status(self) -> dict[str, int]:
+        rows = self.connect().execute(
+            "SELECT status, COUNT(*) FROM publish_jobs WHERE status IN ('pending', 'running') GROUP BY status"
+        ).fetchall()
+        counts = {"pending": 0, "running": 0}
+        counts.update({row[0]: row[1] for row in rows})
+        return counts
+
+    def get_network_results(self, job_id: int) -> dict[str, tuple[bool, str]]:
+        rows = self.connect().execute(
+            "SELECT network, status, result FROM publish_network_jobs "
+            "WHERE job_id = ? AND status IN ('done', 'failed') AND result IS NOT NULL", (job_id,)
+        ).fetchall()
+        return {row["network"]: (row["status"] == "done", row["result"]) for row in rows}
+
+    def get_active_posts(self) -> list[dict]:
+        rows = self.connect().execute(
+            "SELECT post FROM publish_jobs WHERE status IN ('pending', 'running')"
+        ).fetchall()
+        return [json.loads(row["post"]) for row in rows]
+
+    def finish(self, job_id: int):
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "UPDATE publish_jobs SET status = 'done', updated_at = ? WHERE id = ?", (time.time(), job_id)
             )
 
-            tumblr_info = tumblr_api.info()
-            tumblr_user = tumblr_info['user']['name']
+    def fail(self, job_id: int, error: str):
+        # Networks the job never got to are reported as failed instead of staying 'running' forever
+        connection = self.connect()
+        now = time.time()
+        with connection:
+            connection.execute(
+                "UPDATE publish_network_jobs SET status = 'failed', result = '❌ Failed to create ' || network || ' post' "
+                "|| char(10) || ?, updated_at = ? WHERE job_id = ? AND status IN ('pending', 'running')",
+                (error, now, job_id)
+            )
+            connection.execute(
+                "UPDATE publish_jobs SET status = 'failed', updated_at = ? WHERE id = ?", (now, job_id)
+            )
 
-            files = get_media_files()
-            if len(files) > 0:
-                mime, _ = mimetypes.guess_type(files[-1])
-                if mime.startswith("image/"):
-                    tumblr_response = tumblr_api.create_photo(tumblr_user, tags=clean_tags,
-                                                              caption=format_links(english_text),
-                                                              format="markdown",
-                                                              data=files)
-                elif mime.startswith("video/"):
-                    tumblr_response = tumblr_api.create_video(tumblr_user, tags=clean_tags,
-                                                              caption=format_links(english_text),
-                                                              format="markdown",
-                                                              data=files)
-            else:
-                tumblr_response = tumblr_api.create_text(tumblr_user, tags=clean_tags,
-                                                         body=format_links(english_text))
-            if tumblr_response and tumblr_response['id']:
-                tumblr_url = f"https://tumblr.com/{tumblr_user}/{tumblr_response['id']}"
-                await bot.send_message(chat_id=message.chat.id,
-                    text=f"✅ Created Tumblr post: {tumblr_url}"
-                )
+    def requeue_interrupted(self):
+        # Jobs that were running when the process stopped continue with the networks that never started.
+        # A network that was being posted to may have published already, posting it again would duplicate it
+        connection = self.connect()
+        with connection:
+            connection.execute("UPDATE publish_jobs SET status = 'pending' WHERE status = 'running'")
+            connection.execute(
+                "UPDATE publish_network_jobs SET status = 'failed', "
+                "result = '⚠️ ' || network || ' post was interrupted, it may have been published', updated_at = ? "
+                "WHERE status = 'running'",
+                (time.time(),)
+            )
 
-        except Exception as e:
-            await bot.send_message(chat_id=message.chat.id, text=f"❌ Failed to create Tumblr post\n{str(e)}")
+    async def worker(self):
+        while not self.stopping:
+            job = self.claim()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
 
-    async def upload_to_bsky(self, message: Message):
+            job_id, post, networks = job
+            self.running.add(job_id)
+            try:
+                await self.handler(job_id, post, networks)
+                self.finish(job_id)
+            except Exception as e:
+                print(f"Error processing publish job {job_id}: {e}")
+                self.fail(job_id, str(e))
+                await self.failure_handler(job_id, post, e)
+            finally:
+                self.running.discard(job_id)
+
+    async def start(self):
+        self.requeue_interrupted()
+        self.stopping = False
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        self.wakeup.set()
+
+    async def stop(self):
+        # Posts being published get a chance to finish, whatever is left is resumed after the restart
+        self.stopping = True
+        self.wakeup.set()
+        if self.running and self.drain_timeout:
+            print(f"Waiting up to {self.drain_timeout}s for {len(self.running)} publish jobs to finish")
+        if self.tasks and self.drain_timeout:
+            await asyncio.wait(self.tasks, timeout=self.drain_timeout)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+async def process_publish_job(job_id: int, post: dict, networks: list[str]):
+    # Posts queued before status messages existed get their results as a new message
+    progress = None
+    if post.get("status_message_id"):
+        progress = PublishProgress(post["status_chat_id"], post["status_message_id"], post["networks"],
+                                   publish_queue.get_network_results(job_id))
+        progress.show()
+
+    async def on_result(network: str, ok: bool, text: str):
+        publish_queue.set_network_state(job_id, network, "done" if ok else "failed", text)
+        if progress is not None:
+            progress.finished(network, ok, text)
+
+    def on_start(network: str):
+        publish_queue.set_network_state(job_id, network, "running")
+
+    started = time.perf_counter()
+    await PostPublisher(post, progress).publish(networks, on_result, on_start)
+    post_publish_duration.observe(time.perf_counter() - started, profile=post["profile"])
+
+    await media_stagings.discard(post["chat_id"], post["user_id"], post["draft_id"])
+    await report_publish_results(job_id, post, progress)
+
+async def report_publish_results(job_id: int, post: dict, progress: PublishProgress | None):
+    if progress is not None:
+        await progress.close()
+        return
+    results = publish_queue.get_results(job_id)
+    if results:
+        await bot.send_message(chat_id=post["chat_id"], text="\n\n".join(results))
+
+async def report_publish_failure(job_id: int, post: dict, error: Exception):
+    await media_stagings.discard(post["chat_id"], post["user_id"], post["draft_id"])
+    progress = None
+    if post.get("status_message_id"):
+        progress = PublishProgress(post["status_chat_id"], post["status_message_id"], post["networks"],
+                                   publish_queue.get_network_results(job_id))
+    try:
+        await report_publish_results(job_id, post, progress)
+    except Exception as e:
+        print(f"Error reporting failed publish job {job_id}: {e}")
+
+publish_queue = PublishQueue(DATABASE, QUEUE_WORKERS, process_publish_job, report_publish_failure,
+                             PUBLISH_DRAIN_TIMEOUT)
+metrics.add(Gauge("bot_publish_queue_jobs", "Publish jobs waiting or being published", ("status",),
+                  collect=lambda: {(status,): count for status, count in publish_queue.count_by_status().items()}))
+
+class PostScheduler:
+    def __init__(self, path: str, on_due):
+        self.path = path
+        self.on_due = on_due
+        self.connection = None
+        self.heap: list[tuple[float, int]] = []
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS scheduled_posts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    due_at REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    post TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS scheduled_posts_status ON scheduled_posts(status, due_at);
+            """)
+        return self.connection
+
+    def add(self, post: dict, due_at: float) -> int:
+        connection = self.connect()
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO scheduled_posts (due_at, status, post, created_at) VALUES (?, 'scheduled', ?, ?)",
+                (due_at, json.dumps(post), time.time())
+            )
+        heapq.heappush(self.heap, (due_at, cursor.lastrowid))
+        # Only wakes the timer when the new post is due before the one it sleeps for
+        if self.heap[0][1] == cursor.lastrowid:
+            self.changed.set()
+        return cursor.lastrowid
+
+    def get_scheduled_posts(self) -> list[dict]:
+        rows = self.connect().execute("SELECT post FROM scheduled_posts WHERE status = 'scheduled'").fetchall()
+        return [json.loads(row["post"]) for row in rows]
+
+    def load(self):
+        rows = self.connect().execute("SELECT id, due_at FROM scheduled_posts WHERE status = 'scheduled'").fetchall()
+        self.heap = [(row["due_at"], row["id"]) for row in rows]
+        heapq.heapify(self.heap)
+
+    async def fire(self, schedule_id: int):
+        connection = self.connect()
+        row = connection.execute(
+            "SELECT post FROM scheduled_posts WHERE id = ? AND status = 'scheduled'", (schedule_id,)
+        ).fetchone()
+        if row is None:
+            return
         try:
-            data: FSMData = await self.wizard.get_data()
-            profile_settings = data.get("profile_settings")
-            english_text = data.get("english_text")
-            bsky_tags = data.get("bsky_tags")
-            bsky_reply_post = data.get("bsky_reply_post")
-
-            embeds = []
-
-            bluesky_api = Client()
-            bluesky_api.login(profile_settings["BLUESKY_LOGIN"], profile_settings["BLUESKY_PASSWORD"])
-
-            files = get_media_files()
-            is_video = False
-            for file in files:
-                with open(file, "rb+") as f:
-                    f.seek(0)
-                    blob = f.read()
-
-                    mime, _ = mimetypes.guess_type(file)
-                    uploaded_blob = bluesky_api.upload_blob(blob).blob
-
-                    if mime.startswith("image/"):
-                        embeds.append(models.AppBskyEmbedImages.Image(
-                                        image=uploaded_blob,
-                                        alt="",
-                                        aspect_ratio=models.AppBskyEmbedDefs.AspectRatio(width=1, height=1),
-                        ))
-                    elif mime.startswith("video/"):
-                        embeds.append(models.AppBskyEmbedVideo.Main(
-                            video=uploaded_blob,
-                            alt="",
-                            aspect_ratio=models.AppBskyEmbedDefs.AspectRatio(width=1, height=1),
-                        ))
-                        is_video = True
-
-            facets = []
-            for hashtag in bsky_tags:
-                facets.append(models.AppBskyRichtextFacet.Main(
-                    features=[models.AppBskyRichtextFacet.Tag(tag=hashtag)],
-                    index=models.AppBskyRichtextFacet.ByteSlice(byte_start=len(english_text),
-                                                                byte_end=len(english_text)))
-                )
-
-            url_positions = extract_url_byte_positions(english_text)
-            for link_data in url_positions:
-                uri, byte_start, byte_end = link_data
-                facets.append(
-                    models.AppBskyRichtextFacet.Main(
-                        features=[models.AppBskyRichtextFacet.Link(uri=uri)],
-                        index=models.AppBskyRichtextFacet.ByteSlice(byte_start=byte_start, byte_end=byte_end),
-                    )
-                )
+            # A crash can't leave the post both enqueued and scheduled, that would publish it again on restart
+            with connection:
+                connection.execute("UPDATE scheduled_posts SET status = 'fired' WHERE id = ?", (schedule_id,))
+                self.on_due(connection, json.loads(row["post"]))
+        except Exception as e:
+            print(f"Error publishing scheduled post {schedule_id}: {e}")
+            with connection:
+                connection.execute("UPDATE scheduled_posts SET status = 'failed' WHERE id = ?", (schedule_id,))
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            now = time.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[1])
+            if due:
+                await asyncio.gather(*(self.fire(schedule_id) for schedule_id in due))
+
+            timeout = max(self.heap[0][0] - time.time(), 0) if self.heap else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        self.load()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def publish_scheduled_post(connection: sqlite3.Connection, post: dict):
+    publish_queue.add_job(connection, post)
+
+post_scheduler = PostScheduler(DATABASE, publish_scheduled_post)
+
+def remove_expired_media():
+    # Queued and scheduled posts still need their media, however old the draft is
+    posts = publish_queue.get_active_posts() + post_scheduler.get_scheduled_posts()
+    media_stagings.remove_expired(keep={
+        media_stagings.get_path(post["chat_id"], post["user_id"], post["draft_id"]) for post in posts
+    })
+    media_processor.remove_expired()
+
+class PeriodicTask:
+    def __init__(self, interval: float, func):
+        self.interval = interval
+        self.func = func
+        self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.func()
+            except Exception as e:
+                print(f"Error running {self.func.__name__}: {e}")
 
-            reply_ref = None
-            if bsky_reply_post:
-                url_parts = bsky_reply_post.split('/')
-                handle = url_parts[4]
-                post_rkey = url_parts[6]
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
 
-                did = resolver.IdResolver().handle.resolve(handle)
-                if not did:
-                    await bot.send_message(chat_id=message.chat.id, text=f'Could not resolve DID for handle "{handle}".')
-                    return
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
 
-                response = bluesky_api.get_post(post_rkey, did)
-
-                record_ref = models.ComAtprotoRepoStrongRef.Main(
-                    cid=response.cid,
-                    uri=response.uri
-                )
-                reply_ref = models.AppBskyFeedPost.ReplyRef(
-                    parent=record_ref, root=record_ref
-                )
-            if not is_video:
-                bluesky_response = bluesky_api.send_post(text=english_text, langs=["en-US"],
-                                                         embed=models.AppBskyEmbedImages.Main(
-                                                             images=embeds
-                                                         ),
-                                                         reply_to=reply_ref,
-                                                         facets=facets
-                )
-            else:
-                bluesky_response = bluesky_api.send_post(text=english_text, langs=["en-US"],
-                                                         embed=embeds[0],
-                                                         facets=facets
-                )
-            if bluesky_response and bluesky_response["uri"]:
-                at_uri = bluesky_response["uri"]
-                parts = at_uri[5:].split("/")
-                if len(parts) == 3:
-                    did, collection, rkey = parts
-
-                    if collection == "app.bsky.feed.post":
-                        bluesky_url = f"https://bsky.app/profile/{did}/post/{rkey}"
-                        await bot.send_message(chat_id=message.chat.id, text=f"✅ Created Bluesky post: {bluesky_url}")
-        except Exception as e:
-            await bot.send_message(chat_id=message.chat.id,
-                text=f"❌ Failed to create Bluesky post\n{str(e)}"
-            )
+# Drafts nobody comes back to expire while the bot keeps running, not only on /start or a restart
+media_sweeper = PeriodicTask(MEDIA_SWEEP_INTERVAL, remove_expired_media)
 
+class SendScene(CancellableScene, state="SendScene"):
     @on.callback_query.enter()
     @on.message.enter()
     async def on_enter_callback(self, event: Message | CallbackQuery):
-        data: FSMData = await self.wizard.get_data()
-        networks = data.get("networks")
+        draft = await self.get_draft()
+        key = self.wizard.state.key
 
         if isinstance(event, CallbackQuery):
             message = event.message
         else:
             message = event
 
-        if Networks.Telegram.name in networks:
-            await self.upload_to_tg(message)
-        if Networks.VK.name in networks:
-            await self.upload_to_vk(message)
-        if Networks.Twitter.name in networks:
-            await self.upload_to_twitter(message)
-        if Networks.Tumblr.name in networks:
-            await self.upload_to_tumblr(message)
-        if Networks.Bluesky.name in networks:
-            await self.upload_to_bsky(message)
+        if not draft.answer_message_id:
+            status_message = await bot.send_message(chat_id=message.chat.id, text="⏳")
+            draft.answer_chat_id = status_message.chat.id
+            draft.answer_message_id = status_message.message_id
+
+        post = draft.to_post(key.chat_id, key.user_id)
+        scheduled_at = draft.scheduled_at
+        if scheduled_at:
+            due = datetime.fromtimestamp(scheduled_at, SCHEDULE_TIMEZONE).strftime(SCHEDULE_FORMAT)
+            await self.edit_answer(draft, f"🕒 Post scheduled for {due} ({SCHEDULE_TIMEZONE.key})")
+            post_scheduler.add(post, scheduled_at)
+        else:
+            # The status is shown before the job starts editing it
+            progress = PublishProgress(draft.answer_chat_id, draft.answer_message_id, post["networks"])
+            await self.edit_answer(draft, progress.render())
+            publish_queue.enqueue(post)
 
-        remove_media_files()
-        await self.wizard.update_data(answer_message=None)
+        # The queued job owns the draft's media and the status message now, a new draft must not touch them
+        draft.answer_message_id = None
+        draft.draft_id = None
+        await self.save_draft(draft)
 
 class PicturesScene(CancellableScene, state="pictures"):
-    async def message_enter(self, message: Message):
-        data: FSMData = await self.wizard.get_data()
-        answer_message = data.get("answer_message")
-
+    def get_menu(self, draft: PostDraft) -> tuple[str, InlineKeyboardMarkup]:
         menu_builder = InlineKeyboardBuilder()
         menu_builder.row(
             InlineKeyboardButton(text="Skip", callback_data="skip_pictures"),
@@ -461,21 +2924,30 @@ class PicturesScene(CancellableScene, state="pictures"):
             BUTTON_CANCEL
         )
 
-        await answer_message.edit_text(
-            "Send Pictures/Videos for your post (Maximum 4):",
-            reply_markup=menu_builder.as_markup()
-        )
+        text = "Send Pictures/Videos for your post (Maximum 4):"
+        if draft.media:
+            text += f"\n\n📎 Added {len(draft.media)} media"
+        return text, menu_builder.as_markup()
+
+    async def message_enter(self, message: Message):
+        draft = await self.get_draft()
+        text, markup = self.get_menu(draft)
+        await self.edit_answer(draft, text, reply_markup=markup)
 
     @on.callback_query(F.data == "skip_pictures")
     async def skip_callback(self, callback_query: CallbackQuery):
-        os.remove(MEDIA_DIR)
-        os.makedirs(MEDIA_DIR, exist_ok=True)
+        draft = await self.get_draft()
+        await self.clear_media(draft)
+        await self.save_draft(draft)
 
+        await message_editor.discard(draft.answer_chat_id, draft.answer_message_id)
         await callback_query.message.edit_reply_markup(reply_markup=None)
         await self.wizard.goto(TwitterReplyScene)
 
     @on.callback_query(F.data == "finish_sending")
     async def finish_callback(self, callback_query: CallbackQuery):
+        draft = await self.get_draft()
+        await message_editor.discard(draft.answer_chat_id, draft.answer_message_id)
         await callback_query.message.edit_reply_markup(reply_markup=None)
         await self.wizard.goto(TwitterReplyScene)
 
@@ -492,65 +2964,38 @@ class PicturesScene(CancellableScene, state="pictures"):
 
     @on.message()
     async def on_media_choose(self, message: Message):
-        async with download_lock:
-            try:
-                data: FSMData = await self.wizard.get_data()
-                answer_message = data.get("answer_message")
-                networks = data.get("networks")
-
-                os.makedirs(MEDIA_DIR, exist_ok=True)
-
-                file_id = -1
-                target_path = ""
-                number_of_medias = get_media_next_number()
-
-                menu_builder = InlineKeyboardBuilder()
-                menu_builder.row(
-                    InlineKeyboardButton(text="Skip", callback_data="skip_pictures"),
-                    InlineKeyboardButton(text="Finish", callback_data="finish_sending")
-                )
-                menu_builder.row(
-                    BUTTON_BACK,
-                    BUTTON_CANCEL
-                )
-
-                if message.document:
-                    filename = message.document.file_name
-                    ext = os.path.splitext(filename)[1] or ""
-
-                    target_filename = f"media_{number_of_medias}{ext}"
-                    target_path = os.path.join(MEDIA_DIR, target_filename)
-
-                    file_id = message.document.file_id
-                elif message.photo:
-                    filename = "media.jpg"
-                    ext = os.path.splitext(filename)[1] or ""
-
-                    target_filename = f"media_{number_of_medias}{ext}"
-                    target_path = os.path.join(MEDIA_DIR, target_filename)
+        album = await album_collector.collect(message)
+        if not album:
+            return
 
-                    file_id = message.photo[-1].file_id
-                elif message.video:
-                    filename = message.video.file_name
-                    ext = os.path.splitext(filename)[1] or ""
+        draft = await self.get_draft()
+        staging = self.get_staging(draft)
+        async with staging.lock:
+            try:
+                # Another album may have been added while this one was collected
+                draft = await self.get_draft(reload=True)
+                staging.keep_reserved(draft.media)
+                networks = draft.networks
 
-                    target_filename = f"media_{number_of_medias}{ext}"
-                    target_path = os.path.join(MEDIA_DIR, target_filename)
+                new_medias = [media for media in (get_media_item(m, staging) for m in album) if media]
+                if not new_medias:
+                    return
+                draft.media.extend(new_medias)
+                await self.save_draft(draft)
 
-                    file_id = message.video.file_id
+                upload_networks = [network for network in networks if network != Networks.Telegram.name]
+                if MEDIA_PREFETCH and upload_networks:
+                    staging.start_prefetch(new_medias, upload_networks)
 
-                file = await bot.get_file(file_id=file_id)
-                await bot.download_file(file_path=file.file_path, destination=target_path)
-                await message.answer(
-                    f"Added media"
-                )
+                # Albums arriving one after another end up in a single edit of the control message
+                text, markup = self.get_menu(draft)
+                message_editor.edit(draft.answer_chat_id, draft.answer_message_id, text, reply_markup=markup)
             except Exception as e:
                 await bot.send_message(chat_id=message.chat.id, text=str(e))
 
 class TagsScene(CancellableScene, state="tags"):
     async def message_enter(self, message: Message):
-        data: FSMData = await self.wizard.get_data()
-        answer_message = data.get("answer_message")
+        draft = await self.get_draft()
 
         menu_builder = InlineKeyboardBuilder()
         menu_builder.row(
@@ -561,15 +3006,16 @@ class TagsScene(CancellableScene, state="tags"):
             BUTTON_CANCEL
         )
 
-        await answer_message.edit_text(
+        await self.edit_answer(
+            draft,
             "Choose tags:",
             reply_markup=menu_builder.as_markup()
         )
 
     @on.callback_query(F.data == "skip_tags")
     async def skip_callback(self, callback_query: CallbackQuery):
-        data: FSMData = await self.wizard.get_data()
-        networks = data.get("networks")
+        draft = await self.get_draft()
+        networks = draft.networks
 
         await callback_query.message.edit_reply_markup(reply_markup=None)
         if Networks.Bluesky.name not in networks:
@@ -580,7 +3026,9 @@ class TagsScene(CancellableScene, state="tags"):
     @on.callback_query.enter()
     @on.message.enter()
     async def on_enter_callback(self, event: Message | CallbackQuery):
-        remove_media_files()
+        draft = await self.get_draft()
+        await self.clear_media(draft)
+        await self.save_draft(draft)
         if isinstance(event, CallbackQuery):
             if event.data == "skip_tags":
                 await self.skip_callback(event)
@@ -594,14 +3042,15 @@ class TagsScene(CancellableScene, state="tags"):
         unique_words = set(word.strip("#,") for word in message.text.split())
         unique_words = sorted(unique_words)
 
-        data: FSMData = await self.wizard.get_data()
-        networks = data.get("networks")
+        draft = await self.get_draft()
+        networks = draft.networks
 
         clean_tags = unique_words
         tags = ", ".join([f"#{word}" for word in unique_words])
 
-        await self.wizard.update_data(clean_tags=clean_tags)
-        await self.wizard.update_data(tags=tags)
+        draft.clean_tags = clean_tags
+        draft.tags = tags
+        await self.save_draft(draft)
 
         await message.answer(
             f"Added {len(clean_tags)} tags"
@@ -618,8 +3067,7 @@ class TagsScene(CancellableScene, state="tags"):
 
 class HiddenBskyTagsScene(CancellableScene, state="bsky_tags"):
     async def message_enter(self, message: Message):
-        data: FSMData = await self.wizard.get_data()
-        answer_message = data.get("answer_message")
+        draft = await self.get_draft()
 
         menu_builder = InlineKeyboardBuilder()
         menu_builder.row(
@@ -630,7 +3078,8 @@ class HiddenBskyTagsScene(CancellableScene, state="bsky_tags"):
             BUTTON_CANCEL
         )
 
-        await answer_message.edit_text(
+        await self.edit_answer(
+            draft,
             "Choose Bluesky hidden tags:",
             reply_markup=menu_builder.as_markup()
         )
@@ -643,7 +3092,9 @@ class HiddenBskyTagsScene(CancellableScene, state="bsky_tags"):
     @on.callback_query.enter()
     @on.message.enter()
     async def on_enter_callback(self, event: Message | CallbackQuery):
-        remove_media_files()
+        draft = await self.get_draft()
+        await self.clear_media(draft)
+        await self.save_draft(draft)
         if isinstance(event, CallbackQuery):
             if event.data == "skip_bsky_tags":
                 await self.skip_callback(event)
@@ -657,7 +3108,9 @@ class HiddenBskyTagsScene(CancellableScene, state="bsky_tags"):
         unique_words = set(word.strip("#,") for word in message.text.split())
         unique_words = sorted(unique_words)
 
-        await self.wizard.update_data(bsky_tags=unique_words)
+        draft = await self.get_draft()
+        draft.bsky_tags = unique_words
+        await self.save_draft(draft)
 
         await message.answer(
             f"Added {len(unique_words)} Bluesky tags"
@@ -671,8 +3124,7 @@ class HiddenBskyTagsScene(CancellableScene, state="bsky_tags"):
 
 class EnglishTextScene(CancellableScene, state="english_text"):
     async def message_enter(self, message: Message):
-        data: FSMData = await self.wizard.get_data()
-        answer_message = data.get("answer_message")
+        draft = await self.get_draft()
 
         menu_builder = InlineKeyboardBuilder()
         menu_builder.row(
@@ -683,7 +3135,8 @@ class EnglishTextScene(CancellableScene, state="english_text"):
             BUTTON_CANCEL
         )
 
-        await answer_message.edit_text(
+        await self.edit_answer(
+            draft,
             "Type post (in English):",
             reply_markup=menu_builder.as_markup()
         )
@@ -707,15 +3160,16 @@ class EnglishTextScene(CancellableScene, state="english_text"):
 
     @on.message()
     async def on_english_text_choice(self, message: Message):
-        await self.wizard.update_data(english_text=message.text)
+        draft = await self.get_draft()
+        draft.english_text = message.text
+        await self.save_draft(draft)
         await message.delete()
         await self.wizard.goto(TagsScene)
 
 class RussianTextScene(CancellableScene, state="russian_text"):
     @on.callback_query.enter()
     async def on_enter_callback(self, callback_query: CallbackQuery):
-        data: FSMData = await self.wizard.get_data()
-        answer_message = data.get("answer_message")
+        draft = await self.get_draft()
 
         menu_builder = InlineKeyboardBuilder()
         menu_builder.row(
@@ -726,14 +3180,17 @@ class RussianTextScene(CancellableScene, state="russian_text"):
             BUTTON_CANCEL
         )
 
-        await answer_message.edit_text(
+        await self.edit_answer(
+            draft,
             "Type post (in Russian):",
             reply_markup=menu_builder.as_markup()
         )
 
     @on.message()
     async def on_russian_text_choice(self, message: Message):
-        await self.wizard.update_data(russian_text=message.text)
+        draft = await self.get_draft()
+        draft.russian_text = message.text
+        await self.save_draft(draft)
         await message.delete()
         await self.wizard.goto(EnglishTextScene)
 
@@ -746,9 +3203,8 @@ class TwitterReplyScene(CancellableScene, state="twitter_reply"):
     @on.callback_query.enter()
     @on.message.enter()
     async def on_enter_callback(self, event: Message | CallbackQuery):
-        data: FSMData = await self.wizard.get_data()
-        networks = data.get("networks")
-        answer_message = data.get("answer_message")
+        draft = await self.get_draft()
+        networks = draft.networks
 
         if Networks.Twitter.name not in networks:
             await self.wizard.goto(BskyReplyScene)
@@ -763,14 +3219,17 @@ class TwitterReplyScene(CancellableScene, state="twitter_reply"):
             BUTTON_CANCEL
         )
 
-        await answer_message.edit_text(
+        await self.edit_answer(
+            draft,
             "Link Twitter post if you want to reply:",
             reply_markup=menu_builder.as_markup()
         )
 
     @on.message()
     async def on_twitter_reply_choice(self, message: Message):
-        await self.wizard.update_data(twitter_reply_post=message.text)
+        draft = await self.get_draft()
+        draft.twitter_reply_post = message.text
+        await self.save_draft(draft)
         await message.delete()
         await self.wizard.goto(BskyReplyScene)
 
@@ -783,12 +3242,11 @@ class BskyReplyScene(CancellableScene, state="bsky_reply"):
     @on.callback_query.enter()
     @on.message.enter()
     async def on_enter_callback(self, event: Message | CallbackQuery):
-        data: FSMData = await self.wizard.get_data()
-        networks = data.get("networks")
-        answer_message = data.get("answer_message")
+        draft = await self.get_draft()
+        networks = draft.networks
 
         if Networks.Bluesky.name not in networks:
-            await self.wizard.goto(SendScene)
+            await self.wizard.goto(ScheduleScene)
             return
 
         menu_builder = InlineKeyboardBuilder()
@@ -800,31 +3258,81 @@ class BskyReplyScene(CancellableScene, state="bsky_reply"):
             BUTTON_CANCEL
         )
 
-        await answer_message.edit_text(
+        await self.edit_answer(
+            draft,
             "Link Bluesky post if you want to reply:",
             reply_markup=menu_builder.as_markup()
         )
 
     @on.message()
     async def on_bsky_reply_choice(self, message: Message):
-        await self.wizard.update_data(bsky_reply_post=message.text)
+        draft = await self.get_draft()
+        draft.bsky_reply_post = message.text
+        await self.save_draft(draft)
         await message.delete()
-        await self.wizard.goto(SendScene)
+        await self.wizard.goto(ScheduleScene)
 
     @on.callback_query(F.data == "skip_bsky_reply")
     async def skip_callback(self, callback_query: CallbackQuery):
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await self.wizard.goto(ScheduleScene)
+
+class ScheduleScene(CancellableScene, state="schedule"):
+    @on.callback_query.enter()
+    @on.message.enter()
+    async def on_enter_callback(self, event: Message | CallbackQuery):
+        draft = await self.get_draft()
+
+        menu_builder = InlineKeyboardBuilder()
+        menu_builder.row(
+            InlineKeyboardButton(text="Publish now", callback_data="publish_now"),
+        )
+        menu_builder.row(
+            BUTTON_BACK,
+            BUTTON_CANCEL
+        )
+
+        await self.edit_answer(
+            draft,
+            f"Send date and time to schedule the post ({SCHEDULE_FORMAT_HINT}, {SCHEDULE_TIMEZONE.key}) "
+            f"or publish it now:",
+            reply_markup=menu_builder.as_markup()
+        )
+
+    @on.message()
+    async def on_schedule_choice(self, message: Message):
+        try:
+            scheduled_at = datetime.strptime(message.text.strip(), SCHEDULE_FORMAT).replace(tzinfo=SCHEDULE_TIMEZONE)
+        except (AttributeError, ValueError):
+            await message.answer(f"Can't read the date, use {SCHEDULE_FORMAT_HINT}")
+            return
+        if scheduled_at.timestamp() <= time.time():
+            await message.answer("This time has already passed")
+            return
+
+        draft = await self.get_draft()
+        draft.scheduled_at = scheduled_at.timestamp()
+        await self.save_draft(draft)
+        await message.delete()
+        await self.wizard.goto(SendScene)
+
+    @on.callback_query(F.data == "publish_now")
+    async def publish_now_callback(self, callback_query: CallbackQuery):
+        draft = await self.get_draft()
+        draft.scheduled_at = None
+        await self.save_draft(draft)
         await callback_query.message.edit_reply_markup(reply_markup=None)
         await self.wizard.goto(SendScene)
 
 class SocialNetworkScene(CancellableScene, state="social_network"):
     @on.callback_query.enter()
     async def on_enter_callback(self, callback_query: CallbackQuery):
-        data: FSMData = await self.wizard.get_data()
-        networks = data.get("networks")
-        profile = data.get("profile")
-        answer_message = data.get("answer_message")
+        draft = await self.get_draft()
+        networks = draft.networks
+        profile = draft.profile
 
-        await answer_message.edit_text(
+        await self.edit_answer(
+            draft,
             f"Choose social networks for {profile}:",
             reply_markup=generate_choose_network_keyboard(networks).as_markup(),
         )
@@ -832,8 +3340,8 @@ class SocialNetworkScene(CancellableScene, state="social_network"):
     @on.callback_query(F.data.startswith("network:"))
     async def network_callback(self, callback_query: CallbackQuery):
         try:
-            data: FSMData = await self.wizard.get_data()
-            networks = data.get("networks")
+            draft = await self.get_draft()
+            networks = draft.networks
 
             networks_data = callback_query.data.split(":")
             network = networks_data[-1]
@@ -843,7 +3351,7 @@ class SocialNetworkScene(CancellableScene, state="social_network"):
             else:
                 networks.append(network)
 
-            await self.wizard.update_data(networks=networks)
+            await self.save_draft(draft)
 
             new_keyboard = generate_choose_network_keyboard(networks).as_markup()
 
@@ -855,14 +3363,14 @@ class SocialNetworkScene(CancellableScene, state="social_network"):
     @on.callback_query(F.data == "choose_all")
     async def choose_all_callback(self, callback_query: CallbackQuery):
         try:
-            data: FSMData = await self.wizard.get_data()
-            networks = data.get("networks")
+            draft = await self.get_draft()
+            networks = draft.networks
 
             for network in SOCIAL_NETWORKS:
                 if network not in networks:
                     networks.append(network)
 
-            await self.wizard.update_data(networks=networks)
+            await self.save_draft(draft)
 
             new_keyboard = generate_choose_network_keyboard(networks).as_markup()
 
@@ -874,14 +3382,14 @@ class SocialNetworkScene(CancellableScene, state="social_network"):
     @on.callback_query(F.data == "choose_nothing")
     async def choose_nothing_callback(self, callback_query: CallbackQuery):
         try:
-            data: FSMData = await self.wizard.get_data()
-            networks = data.get("networks")
+            draft = await self.get_draft()
+            networks = draft.networks
 
             for network in SOCIAL_NETWORKS:
                 if network in networks:
                     networks.remove(network)
 
-            await self.wizard.update_data(networks=networks)
+            await self.save_draft(draft)
 
             new_keyboard = generate_choose_network_keyboard(networks).as_markup()
 
@@ -893,22 +3401,18 @@ class SocialNetworkScene(CancellableScene, state="social_network"):
     @on.callback_query(F.data == "finish")
     async def finish_callback(self, callback_query: CallbackQuery):
         try:
-            data: FSMData = await self.wizard.get_data()
-            networks = data.get("networks")
+            draft = await self.get_draft()
+            networks = draft.networks
             if len(networks) > 0:
                 await self.wizard.goto(RussianTextScene)
         except Exception as e:
             print(e)
 
 class StartScene(CancellableScene, state="start"):
-    async def set_default_data(self):
-        await self.wizard.update_data(profile="")
-        await self.wizard.update_data(networks=[])
-        await self.wizard.update_data(tags="")
-        await self.wizard.update_data(english_text="")
-        await self.wizard.update_data(russian_text="")
-        await self.wizard.update_data(clean_tags=[])
-        await self.wizard.update_data(bsky_tags="")
+    def new_draft(self, draft: PostDraft) -> PostDraft:
+        # Only the control message carries over to the next draft
+        return PostDraft(draft_id=uuid.uuid4().hex, answer_chat_id=draft.answer_chat_id,
+                         answer_message_id=draft.answer_message_id)
 
     @on.callback_query.enter()
     @on.message.enter()
@@ -918,17 +3422,18 @@ class StartScene(CancellableScene, state="start"):
             return
 
         try:
+            draft = await self.get_draft()
             if isinstance(message, CallbackQuery):
                 if message.message.text == "/start":
-                    await self.wizard.update_data(answer_message=None)
+                    draft.answer_message_id = None
             else:
                 if message.text == "/start":
-                    await self.wizard.update_data(answer_message=None)
+                    draft.answer_message_id = None
 
-            data: FSMData = await self.wizard.get_data()
-            answer_message = data.get("answer_message")
-
-            await self.set_default_data()
+            await self.discard_staging(draft)
+            remove_expired_media()
+            draft = self.new_draft(draft)
+            await self.save_draft(draft)
 
             profiles = list(config['profiles'].keys())
 
@@ -938,15 +3443,17 @@ class StartScene(CancellableScene, state="start"):
                                                       callback_data=f"profile:{profile}"))
             menu_builder.adjust(1, 1)
 
-            if not answer_message:
+            if not draft.answer_message_id:
                     answer_message = await message.answer(text="Choose profile",
                                                           reply_markup=menu_builder.as_markup(),
                                                           )
-                    await self.wizard.update_data(answer_message=answer_message)
+                    draft.answer_chat_id = answer_message.chat.id
+                    draft.answer_message_id = answer_message.message_id
+                    await self.save_draft(draft)
             else:
-                await answer_message.edit_text(text="Choose profile",
-                                               reply_markup=menu_builder.as_markup(),
-                                               )
+                await self.edit_answer(draft, text="Choose profile",
+                                       reply_markup=menu_builder.as_markup(),
+                                       )
         except Exception as e:
             print(e)
 
@@ -955,19 +3462,107 @@ class StartScene(CancellableScene, state="start"):
         try:
             profile_data = callback_query.data.split(":")
             profile = profile_data[-1]
-            await self.wizard.update_data(profile=profile)
-            await self.wizard.update_data(profile_settings=config["profiles"][profile])
+            draft = await self.get_draft()
+            draft.profile = profile
+            await self.save_draft(draft)
         except Exception as e:
             print(e)
 
+class WebhookRequestHandler(SimpleRequestHandler):
+    # Updates are handled before answering, so Telegram doesn't send more than max_connections at once
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, max_concurrent_updates: int,
+                 drain_timeout: float):
+        super().__init__(dispatcher, bot, handle_in_background=False, secret_token=secret_token)
+        self.max_concurrent_updates = max_concurrent_updates
+        self.drain_timeout = drain_timeout
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Telegram sends a rejected update again later, nothing piles up in memory
+        if self.active >= self.max_concurrent_updates:
+            return web.Response(status=503, text="Too many updates")
+        self.active += 1
+        self.idle.clear()
+        try:
+            return await super().handle(request)
+        finally:
+            self.active -= 1
+            if not self.active:
+                self.idle.set()
+
+    async def drain(self):
+        if not self.active:
+            return
+        print(f"Waiting up to {self.drain_timeout}s for {self.active} updates to finish")
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.active} updates were still being handled on shutdown")
+
+
+def run_webhook(dp: Dispatcher):
+    # Anyone who finds the URL could post updates as an admin without the secret
+    if not WEBHOOK_SECRET_TOKEN:
+        raise ValueError("webhook.secret_token must be set in webhook mode")
+    handler = WebhookRequestHandler(dp, bot, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONCURRENT_UPDATES,
+                                    WEBHOOK_DRAIN_TIMEOUT)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+
+    async def on_startup(_: web.Application):
+        await dp.emit_startup(bot=bot, dispatcher=dp, **dp.workflow_data)
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                max_connections=WEBHOOK_MAX_CONCURRENT_UPDATES,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+
+    # Updates already accepted are handled first, then the publish queue drains, the session closes last
+    async def on_shutdown(_: web.Application):
+        await handler.drain()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, **dp.workflow_data)
+        await handler.close()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, print=None)
+
+
 def main() -> None:
     os.makedirs(MEDIA_DIR, exist_ok=True)
-    remove_media_files()
-
-    dp = Dispatcher()
-    print("Server started")
+    remove_expired_media()
+
+    if TELEGRAM_RATE_LIMIT_ENABLED:
+        telegram_rate_limiter.install(bot)
+
+    dp = Dispatcher(storage=SQLiteStorage(DATABASE))
+    # The queue creates its tables before the scheduler adds jobs to them
+    dp.startup.register(publish_queue.start)
+    dp.shutdown.register(publish_queue.stop)
+    dp.startup.register(post_scheduler.start)
+    dp.shutdown.register(post_scheduler.stop)
+    dp.startup.register(media_sweeper.start)
+    dp.shutdown.register(media_sweeper.stop)
+    if METRICS_ENABLED:
+        dp.startup.register(metrics.start)
+        dp.shutdown.register(metrics.stop)
+    if CLIENT_WARMUP:
+        dp.startup.register(client_registry.warm_up)
+    else:
+        dp.startup.register(client_registry.restore_sessions)
+    sdk_load_times = load_network_sdks(config["profiles"])
+    startup_time = time.perf_counter() - STARTUP_STARTED_AT
+    loaded = ", ".join(f"{network.name} {load_time:.2f}s" for network, load_time in sdk_load_times.items())
+    print(f"Server started in {startup_time:.2f}s (network SDKs: {loaded or 'none'})")
+    if startup_time > STARTUP_BUDGET:
+        print(f"Startup took longer than the {STARTUP_BUDGET}s budget")
 
     dp.message.register(StartScene.as_handler(), Command("start"))
+    dp.message.register(reset_cache_command, Command("reset_cache"))
     dp.errors.register(global_error_handler)
 
     scene_registry = SceneRegistry(dp)
@@ -981,9 +3576,18 @@ def main() -> None:
     scene_registry.add(HiddenBskyTagsScene)
     scene_registry.add(TwitterReplyScene)
     scene_registry.add(BskyReplyScene)
+    scene_registry.add(ScheduleScene)
     dp.include_router(router)
 
-    dp.run_polling(bot)
+    try:
+        if RUN_MODE == "webhook":
+            run_webhook(dp)
+        else:
+            dp.run_polling(bot)
+    finally:
+        client_registry.close()
+        network_executor.shutdown()
+        media_processor.shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,89 @@
+import struct
+
+import pytest
+from PIL import Image
+
+import main
+
+IDENTITY_MATRIX = (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+ROTATED_MATRIX = (0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def make_mp4(path, brand: bytes, width: int, height: int, duration: float, matrix=IDENTITY_MATRIX):
+    mvhd = bytes(4) + bytes(8) + struct.pack(">II", 1000, int(duration * 1000)) + bytes(80)
+    tkhd = bytes(40) + struct.pack(">9i", *matrix) + struct.pack(">II", width << 16, height << 16)
+    moov = box(b"moov", box(b"mvhd", mvhd) + box(b"trak", box(b"tkhd", tkhd)))
+    path.write_bytes(box(b"ftyp", brand + bytes(4) + brand) + moov + box(b"mdat", bytes(16)))
+
+def make_heif(path, major: bytes, compatible: list[bytes], sizes: list[tuple[int, int]]):
+    ispe = b"".join(box(b"ispe", bytes(4) + struct.pack(">II", *size)) for size in sizes)
+    meta = box(b"meta", bytes(4) + box(b"hdlr", bytes(24)) + box(b"iprp", box(b"ipco", ispe)))
+    path.write_bytes(box(b"ftyp", major + bytes(4) + b"".join(compatible)) + meta + box(b"mdat", bytes(16)))
+
+@pytest.mark.parametrize("name, save_kwargs, mode, mime", [
+    ("image.png", {}, "RGB", "image/png"),
+    ("image.gif", {}, "P", "image/gif"),
+    ("image.jpg", {"quality": 80}, "RGB", "image/jpeg"),
+    ("progressive.jpg", {"progressive": True}, "RGB", "image/jpeg"),
+    ("lossy.webp", {}, "RGB", "image/webp"),
+    ("lossless.webp", {"lossless": True}, "RGB", "image/webp"),
+    ("alpha.webp", {}, "RGBA", "image/webp"),
+])
+def test_probe_image(tmp_path, name, save_kwargs, mode, mime):
+    path = tmp_path / name
+    Image.new(mode, (37, 21)).save(path, **save_kwargs)
+
+    info = main.probe_media(str(path))
+
+    assert info == {"mime": mime, "width": 37, "height": 21, "duration": None, "size": path.stat().st_size}
+
+def test_probe_mp4(tmp_path):
+    path = tmp_path / "video.mp4"
+    make_mp4(path, b"isom", 1280, 720, 12.5)
+
+    info = main.probe_media(str(path))
+
+    assert info["mime"] == "video/mp4"
+    assert (info["width"], info["height"], info["duration"]) == (1280, 720, 12.5)
+
+def test_probe_rotated_quicktime(tmp_path):
+    path = tmp_path / "video.mov"
+    make_mp4(path, b"qt  ", 1920, 1080, 3, ROTATED_MATRIX)
+
+    info = main.probe_media(str(path))
+
+    assert info["mime"] == "video/quicktime"
+    assert (info["width"], info["height"]) == (1080, 1920)
+
+@pytest.mark.parametrize("major, compatible, mime", [
+    (b"heic", [b"mif1", b"heic"], "image/heic"),
+    (b"mif1", [b"mif1", b"heic"], "image/heic"),
+    (b"avif", [b"avif", b"mif1", b"miaf"], "image/avif"),
+    (b"mif1", [b"mif1", b"avif"], "image/avif"),
+])
+def test_probe_heif_photo(tmp_path, major, compatible, mime):
+    path = tmp_path / "photo.heic"
+    # An iPhone photo is a grid of 512px tiles, the grid item carries the full size
+    make_heif(path, major, compatible, [(512, 512), (4032, 3024)])
+
+    info = main.probe_media(str(path))
+
+    assert info["mime"] == mime
+    assert (info["width"], info["height"], info["duration"]) == (4032, 3024, None)
+
+def test_probe_truncated_file_keeps_the_mime(tmp_path):
+    path = tmp_path / "broken.jpg"
+    path.write_bytes(b"\xff\xd8\xff\xe0\x00")
+
+    info = main.probe_media(str(path))
+
+    assert info["mime"] == "image/jpeg"
+    assert info["width"] is None
+
+def test_probe_unknown_file_falls_back_to_extension(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("not media")
+
+    assert main.probe_media(str(path))["mime"] == "text/plain"
@@ -0,0 +1,156 @@
+import asyncio
+import sqlite3
+
+import main
+
+NETWORKS = ["VK", "Twitter", "Tumblr"]
+
+def make_queue(tmp_path, handler=None, failure_handler=None) -> main.PublishQueue:
+    return main.PublishQueue(str(tmp_path / "queue.sqlite3"), 1, handler, failure_handler, 1)
+
+def make_post() -> dict:
+    return {"chat_id": 1, "user_id": 1, "draft_id": "draft", "profile": "test", "networks": list(NETWORKS)}
+
+def get_job_status(tmp_path, job_id: int) -> str:
+    with sqlite3.connect(tmp_path / "queue.sqlite3") as connection:
+        return connection.execute("SELECT status FROM publish_jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+def get_network_statuses(tmp_path, job_id: int) -> dict[str, str]:
+    with sqlite3.connect(tmp_path / "queue.sqlite3") as connection:
+        rows = connection.execute("SELECT network, status FROM publish_network_jobs WHERE job_id = ?", (job_id,))
+        return dict(rows.fetchall())
+
+def test_claim_takes_jobs_in_order(tmp_path):
+    queue = make_queue(tmp_path)
+    first = queue.enqueue(make_post())
+    second = queue.enqueue(make_post())
+
+    assert queue.claim()[0] == first
+    assert queue.claim()[0] == second
+    assert queue.claim() is None
+    assert queue.count_by_status() == {"pending": 0, "running": 2}
+
+def test_requeue_after_interrupt_skips_networks_that_may_have_posted(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.enqueue(make_post())
+    queue.claim()
+    queue.set_network_state(job_id, "VK", "done", "✅ VK")
+    queue.set_network_state(job_id, "Twitter", "running")
+
+    # A new queue over the same file is what the bot sees after a restart
+    restarted = make_queue(tmp_path)
+    restarted.requeue_interrupted()
+    claimed_id, post, networks = restarted.claim()
+
+    assert claimed_id == job_id
+    assert post == make_post()
+    assert networks == ["Tumblr"]
+    results = restarted.get_network_results(job_id)
+    assert results["VK"] == (True, "✅ VK")
+    ok, text = results["Twitter"]
+    assert not ok and "may have been published" in text
+
+def test_worker_finishes_job(tmp_path):
+    handled = []
+
+    async def handler(job_id: int, post: dict, networks: list[str]):
+        handled.append(networks)
+        for network in networks:
+            queue.set_network_state(job_id, network, "done", f"✅ {network}")
+
+    async def run():
+        await queue.start()
+        job_id = queue.enqueue(make_post())
+        while not handled:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return job_id
+
+    queue = make_queue(tmp_path, handler)
+    job_id = asyncio.run(run())
+
+    assert [sorted(networks) for networks in handled] == [sorted(NETWORKS)]
+    assert get_job_status(tmp_path, job_id) == "done"
+    assert set(get_network_statuses(tmp_path, job_id).values()) == {"done"}
+
+def test_worker_fails_job_and_reports_it(tmp_path):
+    failures = []
+
+    async def handler(job_id: int, post: dict, networks: list[str]):
+        queue.set_network_state(job_id, "VK", "done", "✅ VK")
+        queue.set_network_state(job_id, "Twitter", "running")
+        raise RuntimeError("staging is gone")
+
+    async def failure_handler(job_id: int, post: dict, error: Exception):
+        failures.append((job_id, str(error), queue.get_results(job_id)))
+
+    async def run():
+        await queue.start()
+        queue.enqueue(make_post())
+        while not failures:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    queue = make_queue(tmp_path, handler, failure_handler)
+    asyncio.run(run())
+
+    job_id, error, results = failures[0]
+    assert error == "staging is gone"
+    assert results[0] == "✅ VK"
+    assert all("staging is gone" in result for result in results[1:])
+    assert get_job_status(tmp_path, job_id) == "failed"
+    assert get_network_statuses(tmp_path, job_id) == {"VK": "done", "Twitter": "failed", "Tumblr": "failed"}
+
+def test_stop_leaves_unfinished_job_for_restart(tmp_path):
+    started = asyncio.Event()
+
+    async def handler(job_id: int, post: dict, networks: list[str]):
+        started.set()
+        await asyncio.sleep(60)
+
+    async def run():
+        await queue.start()
+        job_id = queue.enqueue(make_post())
+        await started.wait()
+        await queue.stop()
+        return job_id
+
+    queue = make_queue(tmp_path, handler)
+    queue.drain_timeout = 0.1
+    job_id = asyncio.run(run())
+
+    assert get_job_status(tmp_path, job_id) == "running"
+    restarted = make_queue(tmp_path)
+    restarted.requeue_interrupted()
+    assert restarted.claim()[0] == job_id
+
+def get_schedule_status(tmp_path, schedule_id: int) -> str:
+    with sqlite3.connect(tmp_path / "queue.sqlite3") as connection:
+        return connection.execute("SELECT status FROM scheduled_posts WHERE id = ?", (schedule_id,)).fetchone()[0]
+
+def test_fired_post_is_enqueued_in_the_same_transaction(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.connect()
+    scheduler = main.PostScheduler(str(tmp_path / "queue.sqlite3"), queue.add_job)
+    schedule_id = scheduler.add(make_post(), 0)
+
+    asyncio.run(scheduler.fire(schedule_id))
+
+    assert get_schedule_status(tmp_path, schedule_id) == "fired"
+    assert queue.claim()[1] == make_post()
+
+def test_failed_enqueue_leaves_no_job(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.connect()
+
+    def on_due(connection, post: dict):
+        queue.add_job(connection, post)
+        raise RuntimeError("disk full")
+
+    scheduler = main.PostScheduler(str(tmp_path / "queue.sqlite3"), on_due)
+    schedule_id = scheduler.add(make_post(), 0)
+
+    asyncio.run(scheduler.fire(schedule_id))
+
+    assert get_schedule_status(tmp_path, schedule_id) == "failed"
+    assert queue.claim() is None
@@ -0,0 +1,50 @@
+import asyncio
+import sqlite3
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StorageKey
+
+import main
+
+KEY = StorageKey(bot_id=123456, chat_id=1, user_id=2)
+OTHER_KEY = StorageKey(bot_id=123456, chat_id=1, user_id=3)
+
+def test_state_and_data_survive_a_restart(tmp_path):
+    path = str(tmp_path / "storage.sqlite3")
+    draft = main.PostDraft(profile="test", networks=["VK"], russian_text="Привет", media=[{"path": "media_1.jpg"}])
+
+    async def write():
+        storage = main.SQLiteStorage(path)
+        await storage.set_state(KEY, State("pictures", group_name="PicturesScene"))
+        await storage.set_data(KEY, draft.to_data())
+        await storage.close()
+
+    async def read():
+        storage = main.SQLiteStorage(path)
+        result = await storage.get_state(KEY), await storage.get_data(KEY), await storage.get_data(OTHER_KEY)
+        await storage.close()
+        return result
+
+    asyncio.run(write())
+    state, data, other_data = asyncio.run(read())
+
+    assert state == "PicturesScene:pictures"
+    assert main.PostDraft.from_data(data) == draft
+    assert other_data == {}
+
+def test_finished_draft_leaves_no_record(tmp_path):
+    path = str(tmp_path / "storage.sqlite3")
+
+    async def run():
+        storage = main.SQLiteStorage(path)
+        await storage.set_state(KEY, "start")
+        await storage.set_data(KEY, {"profile": "test"})
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        result = await storage.get_state(KEY), await storage.get_data(KEY)
+        await storage.close()
+        return result
+
+    assert asyncio.run(run()) == (None, {})
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM fsm_records").fetchone()[0] == 0
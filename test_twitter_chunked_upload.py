@@ -0,0 +1,96 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+class FakeTwitterApi:
+    def __init__(self, fail_segment: int | None = None, error: Exception | None = None):
+        self.fail_segment = fail_segment
+        self.error = error
+        self.inits = []
+        self.segments = []
+        self.finalized = []
+
+    def chunked_upload_init(self, size: int, mime: str, media_category: str):
+        media_id = len(self.inits) + 100
+        self.inits.append((size, mime, media_category))
+        return SimpleNamespace(media_id=media_id, expires_after_secs=86400)
+
+    def chunked_upload_append(self, media_id: int, media: tuple[str, bytes], segment: int):
+        if segment == self.fail_segment:
+            raise self.error
+        self.segments.append((media_id, segment, media[1]))
+
+    def chunked_upload_finalize(self, media_id: int):
+        self.finalized.append(media_id)
+        return SimpleNamespace(media_id=media_id, processing_info=None)
+
+    def get_media_upload_status(self, media_id: int):
+        raise AssertionError("processing is never pending in these tests")
+
+def make_publisher() -> tuple[main.PostPublisher, str, bytes]:
+    post = {"chat_id": 1, "user_id": 1, "draft_id": uuid.uuid4().hex, "profile": "test", "media": []}
+    publisher = main.PostPublisher(post)
+    path = publisher.staging.reserve_path(".mp4")
+    # Unique bytes keep the partial upload state of one test away from the others
+    data = uuid.uuid4().bytes[:10]
+    with open(path, "wb") as f:
+        f.write(data)
+    return publisher, path, data
+
+def upload(publisher: main.PostPublisher, api: FakeTwitterApi, path: str):
+    return asyncio.run(publisher.upload_chunked_to_twitter(api, path, "video/mp4"))
+
+def get_partial(publisher: main.PostPublisher, path: str) -> dict | None:
+    content_hash = main.hash_file(path)
+    return main.upload_cache.get_partial(content_hash, main.Networks.Twitter, publisher.post["profile"])
+
+def test_upload_sends_every_segment():
+    publisher, path, data = make_publisher()
+    api = FakeTwitterApi()
+
+    media = upload(publisher, api, path)
+
+    assert media.media_id == 100
+    assert api.inits == [(10, "video/mp4", "tweet_video")]
+    assert api.segments == [(100, 0, data[0:4]), (100, 1, data[4:8]), (100, 2, data[8:10])]
+    assert api.finalized == [100]
+    assert get_partial(publisher, path) is None
+
+def test_interrupted_upload_resumes_from_the_last_acknowledged_segment():
+    publisher, path, data = make_publisher()
+    interrupted = FakeTwitterApi(fail_segment=1, error=ConnectionError("connection dropped"))
+
+    with pytest.raises(ConnectionError):
+        upload(publisher, interrupted, path)
+    assert get_partial(publisher, path)["next_segment"] == 1
+
+    # The next attempt may come from a new publisher, the state lives in the upload cache
+    resumed = FakeTwitterApi()
+    retried_publisher = main.PostPublisher(publisher.post)
+    media = upload(retried_publisher, resumed, path)
+
+    assert resumed.inits == []
+    assert resumed.segments == [(100, 1, data[4:8]), (100, 2, data[8:10])]
+    assert resumed.finalized == [100]
+    assert media.media_id == 100
+    assert get_partial(publisher, path) is None
+
+def test_rejected_upload_starts_over():
+    publisher, path, _ = make_publisher()
+    rejected = FakeTwitterApi(fail_segment=1, error=ValueError("media type unrecognized"))
+
+    with pytest.raises(ValueError):
+        upload(publisher, rejected, path)
+    assert get_partial(publisher, path) is None
+
+    restarted = FakeTwitterApi()
+    upload(publisher, restarted, path)
+    assert len(restarted.inits) == 1
+    assert [segment for _, segment, _ in restarted.segments] == [0, 1, 2]
+
+def teardown_module():
+    main.network_executor.shutdown()
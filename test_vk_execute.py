@@ -0,0 +1,75 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import main
+
+FLOOD_CONTROL = {"method": "wall.post", "error_code": 9, "error_msg": "Flood control"}
+
+class FakeVkSession:
+    def __init__(self, responses: list[dict]):
+        self.responses = responses
+        self.scripts = []
+
+    def get_api(self):
+        return SimpleNamespace()
+
+    def method(self, method: str, values: dict, raw: bool = False):
+        assert (method, raw) == ("execute", True)
+        self.scripts.append(values["code"])
+        return self.responses.pop(0)
+
+def make_publisher(vk_session: FakeVkSession) -> main.PostPublisher:
+    post = {"chat_id": 1, "user_id": 1, "draft_id": uuid.uuid4().hex, "profile": "test", "media": [],
+            "russian_text": "Привет", "tags": "#test"}
+    publisher = main.PostPublisher(post)
+    publisher.profile_settings = {"VK_GROUP_ID": 42}
+    publisher.clients = SimpleNamespace(get_vk=lambda: vk_session)
+    return publisher
+
+def test_flood_control_inside_execute_is_retried(monkeypatch):
+    monkeypatch.setitem(main.RETRY_SETTINGS, "attempts", 2)
+    monkeypatch.setitem(main.RETRY_SETTINGS, "base_delay", 0)
+    vk_session = FakeVkSession([
+        {"response": {"photos": [], "post_id": False}, "execute_errors": [FLOOD_CONTROL]},
+        {"response": {"photos": [], "post_id": 7}},
+    ])
+    publisher = make_publisher(vk_session)
+
+    result = asyncio.run(publisher.upload_to_vk())
+
+    assert len(vk_session.scripts) == 2
+    assert result == "✅ Created VK post: https://vk.com/wall-42_7"
+    assert publisher.retry_stats[main.Networks.VK].retries == 1
+
+def test_retry_posts_the_photos_saved_by_the_failed_attempt(monkeypatch):
+    monkeypatch.setitem(main.RETRY_SETTINGS, "attempts", 2)
+    monkeypatch.setitem(main.RETRY_SETTINGS, "base_delay", 0)
+    vk_session = FakeVkSession([
+        {"response": {"photos": ["photo-42_1"], "post_id": False}, "execute_errors": [FLOOD_CONTROL]},
+        {"response": {"photos": [], "post_id": 7}},
+    ])
+    vk_session.http = SimpleNamespace(post=lambda url, files: SimpleNamespace(
+        raise_for_status=lambda: None, json=lambda: {"photo": "[]", "server": 1, "hash": "hash"}
+    ))
+    vk_session.get_api = lambda: SimpleNamespace(photos=SimpleNamespace(
+        getWallUploadServer=lambda group_id: {"upload_url": "https://upload.example"}
+    ))
+    publisher = make_publisher(vk_session)
+    path = publisher.staging.reserve_path(".jpg")
+    with open(path, "wb") as f:
+        # Unique bytes keep the upload cache from answering for this photo
+        f.write(uuid.uuid4().bytes)
+
+    async def get_media_paths(network: main.Networks) -> list[str]:
+        return [path]
+
+    publisher.get_media_paths = get_media_paths
+
+    assert asyncio.run(publisher.upload_to_vk()) == "✅ Created VK post: https://vk.com/wall-42_7"
+    assert "saveWallPhoto" in vk_session.scripts[0]
+    assert "saveWallPhoto" not in vk_session.scripts[1]
+    assert '"photo-42_1"' in vk_session.scripts[1]
+
+def teardown_module():
+    main.network_executor.shutdown()
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from aiogram import Dispatcher
+from aiogram.types import Message
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+
+SECRET = "SECRET"
+
+def make_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Admin"},
+            "text": text,
+        },
+    }
+
+async def replay(dp: Dispatcher, updates: list[dict], secret: str = SECRET) -> list[int]:
+    handler = main.WebhookRequestHandler(dp, main.bot, SECRET, 2, 1)
+    app = web.Application()
+    app.router.add_post("/webhook", handler.handle)
+    async with TestClient(TestServer(app)) as client:
+        responses = await asyncio.gather(*(
+            client.post("/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+            for update in updates
+        ))
+        return [response.status for response in responses]
+
+def test_recorded_update_is_handled():
+    received = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message):
+        received.append(message.text)
+
+    assert asyncio.run(replay(dp, [make_update(1, "hello")])) == [200]
+    assert received == ["hello"]
+
+def test_wrong_secret_is_rejected():
+    received = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message):
+        received.append(message.text)
+
+    assert asyncio.run(replay(dp, [make_update(1, "hello")], secret="WRONG")) == [401]
+    assert received == []
+
+def test_updates_over_the_limit_get_503():
+    dp = Dispatcher()
+    release = asyncio.Event()
+
+    @dp.message()
+    async def on_message(message: Message):
+        await release.wait()
+
+    async def run():
+        replaying = asyncio.create_task(replay(dp, [make_update(update_id, "hello") for update_id in range(3)]))
+        await asyncio.sleep(0.5)
+        release.set()
+        return await replaying
+
+    assert sorted(asyncio.run(run())) == [200, 200, 503]
+
+def test_drain_waits_for_updates_in_progress():
+    dp = Dispatcher()
+    finished = []
+
+    @dp.message()
+    async def on_message(message: Message):
+        await asyncio.sleep(0.2)
+        finished.append(message.text)
+
+    async def run():
+        handler = main.WebhookRequestHandler(dp, main.bot, SECRET, 2, 5)
+        app = web.Application()
+        app.router.add_post("/webhook", handler.handle)
+        async with TestClient(TestServer(app)) as client:
+            request = asyncio.create_task(client.post(
+                "/webhook", json=make_update(1, "hello"), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}
+            ))
+            while not handler.active:
+                await asyncio.sleep(0.01)
+            await handler.drain()
+            assert finished == ["hello"]
+            assert (await request).status == 200
+
+    asyncio.run(run())
+
+def test_webhook_mode_refuses_to_start_without_a_secret(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_SECRET_TOKEN", None)
+
+    with pytest.raises(ValueError):
+        main.run_webhook(Dispatcher())